@@ -10,7 +10,13 @@ Options:
     -v --version   Show version number
 
 Commands:
-    deploy         Claim resources from g5k and configure them
+    full_run       Plot the mean duration of rally actions for a latency
+    percentiles    Show the tail latency of rally actions
+    throughput     Show the throughput of rally actions over time
+    plot           Render every figure to files, without a display
+    sysbench       Show the results of the sysbench runs
+    overlap        Show which rally scenarios ran at the same time
+    metrics        Export the monitoring data of every benchmark run
 
 Run 'analysis COMMAND --help' for more information on a command
 """
@@ -20,53 +26,757 @@ import re
 import os
 import tarfile
 import json
+import hashlib
+import math
+import decimal
+import importlib
+import subprocess
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Pool
 
-import pandas as pd
-import matplotlib.pyplot as plt
 from docopt import docopt
 
-from utils.doc import doc, doc_lookup
+from utils import doc, doc_lookup
 
 
-pd.options.display.float_format = '{:20,.6f}'.format
+class _LazyModule(object):
+    """Imports the module `name` on first attribute access
 
-plt.style.use('seaborn-white')
+    pandas, numpy and matplotlib make up most of the startup time of
+    analysis, `--help` and the commands that do not draw should not pay
+    for them. `setup` is called once with the module after its import.
 
-plt.rcParams['font.family'] = 'serif'
-plt.rcParams['font.serif'] = 'Ubuntu'
-plt.rcParams['font.monospace'] = 'Ubuntu Mono'
-plt.rcParams['font.size'] = 10
-plt.rcParams['axes.labelsize'] = 10
-plt.rcParams['axes.labelweight'] = 'bold'
-plt.rcParams['axes.titlesize'] = 10
-plt.rcParams['xtick.labelsize'] = 6
-plt.rcParams['ytick.labelsize'] = 8
-plt.rcParams['legend.fontsize'] = 10
-plt.rcParams['figure.titlesize'] = 12
+    """
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._setup is not None:
+                self._setup(module)
+            self._module = module
+        return getattr(self._module, attr)
+
+
+def _setup_pandas(pd):
+    pd.options.display.float_format = '{:20,.6f}'.format
+
+
+def _setup_pyplot(plt):
+    plt.style.use('seaborn-white')
+
+    plt.rcParams['font.family'] = 'serif'
+    plt.rcParams['font.serif'] = 'Ubuntu'
+    plt.rcParams['font.monospace'] = 'Ubuntu Mono'
+    plt.rcParams['font.size'] = 10
+    plt.rcParams['axes.labelsize'] = 10
+    plt.rcParams['axes.labelweight'] = 'bold'
+    plt.rcParams['axes.titlesize'] = 10
+    plt.rcParams['xtick.labelsize'] = 6
+    plt.rcParams['ytick.labelsize'] = 8
+    plt.rcParams['legend.fontsize'] = 10
+    plt.rcParams['figure.titlesize'] = 12
+
+
+ijson = _LazyModule('ijson')
+np = _LazyModule('numpy')
+pd = _LazyModule('pandas', _setup_pandas)
+plt = _LazyModule('matplotlib.pyplot', _setup_pyplot)
+
+
+KEY_SCENARIOS = ['authenticate_user_and_validate_token',
+                 'create_add_and_list_user_roles',
+                 'create_and_list_tenants',
+                 'get_entities',
+                 'create_user_update_password',
+                 'create_user_set_enabled_and_delete',
+                 'create_and_list_users']
+
+# delete_user makes everything ugly, see --remove_delete
+DELETE_ACTION = 'keystone_v3.delete_user'
+
+DB_LABELS = {'mariadb': 'M', 'galera': 'G', 'cockroachdb': 'C'}
+
+TABLE_INDEX = ['scenario', 'db', 'nodes', 'name']
+SERIES_INDEX = ['scenario', 'db', 'nodes', 'time']
+
+# ijson prefixes of the parts of a rally report we are interested in
+TITLE_PREFIX = 'tasks.item.subtasks.item.title'
+WORKLOAD_PREFIX = 'tasks.item.subtasks.item.workloads.item'
+ACTION_PREFIX = WORKLOAD_PREFIX + '.data.item.atomic_actions.item'
+
+# Per-directory tables are cached next to the backup folder. Bump the
+# version whenever the content of the cached tables changes.
+CACHE_DIR = 'analysis-cache'
+CACHE_VERSION = 4
+
+# Durations are sketched in logarithmic buckets whose bounds are
+# SKETCH_ACCURACY apart (relative), so that percentiles can be merged
+# across chunks without keeping every sample. Shorter durations than
+# SKETCH_MIN (including zero) fall in the first bucket.
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_MIN = 1e-6
+
+PERCENTILES = [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p99.9', 0.999)]
+
+# Metrics that can be plotted, from the actions and throughput tables
+ACTION_METRICS = ['duration', 'max'] + [p for p, _ in PERCENTILES]
+THROUGHPUT_METRICS = ['ops_per_s', 'in_flight']
 
+# Renders of `analysis plot` are recorded in this file of the output
+# directory. Bump the version whenever figures are drawn differently.
+PLOT_MANIFEST = 'plots.json'
+PLOT_VERSION = 1
 
-DF_0 = []
-DF_50 = []
-DF_150 = []
+# Tarballs of the backup are compressed with gzip, or with zstd or lz4
+# (see `juice backup --compression`), which tarfile reads through their
+# command line decompressor
+TAR_EXT = r'\.tar\.(?:gz|zst|lz4)$'
+TAR_DECOMPRESSORS = {'.zst': ['zstd', '-dc'], '.lz4': ['lz4', '-dc']}
+
+# sysbench reports are `results-<tag>-<run>.log` files in the
+# sysbench-<host> tarballs of the backup folder, where the tag holds the
+# parameters of the run (see the sysbench role defaults). Reports
+# without a tag come from the fixed workload of older juice versions.
+SYSBENCH_TAR = re.compile(r'sysbench-(?P<host>.+)' + TAR_EXT)
+SYSBENCH_LOG = re.compile(r'results-(?:(?P<workload>[a-z_]+)'
+                          r'-threads(?P<threads>\d+)'
+                          r'-tables(?P<tables>\d+)'
+                          r'-size(?P<table_size>\d+)'
+                          r'-time(?P<duration>\d+)-)?'
+                          r'(?P<run>.+)\.log$')
+SYSBENCH_UNTAGGED = {'workload': 'oltp_read_write', 'tables': 1,
+                     'table_size': 1000000, 'duration': 10}
+SYSBENCH_INDEX = ['db', 'nodes', 'workload', 'threads', 'tables',
+                  'table_size', 'duration', 'host', 'run']
+
+# One line per interval with --report-interval, e.g.
+# [ 10s ] thds: 8 tps: 1033.11 qps: 20676.86 (r/w/o: 14475.53/4134.32/
+# 2067.01) lat (ms,95%): 11.24 err/s: 0.00 reconn/s: 0.00
+SYSBENCH_INTERVAL = re.compile(
+    r'\[ *(?P<time>[\d.]+)s \] thds: (?P<threads>\d+)'
+    r' tps: (?P<tps>[\d.]+) qps: (?P<qps>[\d.]+)'
+    r' \(r/w/o: (?P<reads_per_s>[\d.]+)/(?P<writes_per_s>[\d.]+)'
+    r'/(?P<other_per_s>[\d.]+)\)'
+    r' lat \(ms,(?P<percentile>[\d.]+)%\): (?P<latency>[\d.]+)'
+    r' err/s:? (?P<errors_per_s>[\d.]+)'
+    r' reconn/s: (?P<reconnects_per_s>[\d.]+)')
+
+# Lines of the final statistics, e.g. `transactions: 207007 (3449.94 per
+# sec.)` or `95th percentile: 3.89`
+SYSBENCH_STAT = re.compile(r'^\s*(?P<label>[a-z0-9][a-z0-9 .]*?):\s+'
+                           r'(?P<value>[\d.]+)(?:s|ms)?'
+                           r'(?:\s+\((?P<rate>[\d.]+) per sec\.\))?\s*$',
+                           re.IGNORECASE)
+SYSBENCH_PERCENTILE = re.compile(r'(?:approx\. +)?(?P<percentile>[\d.]+)'
+                                 r'(?:th)? percentile')
+
+# Columns of the statistics by label. Labels followed by a rate also
+# fill <column>_per_s, except transactions and queries (tps and qps).
+SYSBENCH_STATS = {'number of threads': 'threads',
+                  'read': 'reads',
+                  'write': 'writes',
+                  'other': 'other',
+                  'transactions': 'transactions',
+                  'queries': 'queries',
+                  'ignored errors': 'errors',
+                  'reconnects': 'reconnects',
+                  'total time': 'time',
+                  'total number of events': 'events',
+                  'min': 'lat_min',
+                  'avg': 'lat_avg',
+                  'max': 'lat_max',
+                  'sum': 'lat_sum'}
+SYSBENCH_RATES = {'transactions': 'tps', 'queries': 'qps'}
+
+# Columns that add up over the clients of a distributed run. Minimum
+# latencies are the min of the clients, other latencies (max and
+# percentiles) the max, which is an upper bound for percentiles.
+SYSBENCH_SUMS = ['threads', 'reads', 'writes', 'other', 'transactions',
+                 'tps', 'queries', 'qps', 'errors', 'errors_per_s',
+                 'reconnects', 'reconnects_per_s', 'events', 'lat_sum',
+                 'reads_per_s', 'writes_per_s', 'other_per_s']
+
+# `juice rally` records the docker inspect of every scenario container in
+# timeline-<run>.jsonl, next to the rally reports
+TIMELINE = re.compile(r'timeline-(?P<run>.+)\.jsonl$')
+TIMELINE_INDEX = ['db', 'nodes', 'run', 'scenario']
+
+# `analysis metrics` reads the InfluxDB data of the backup with a stand-in
+# InfluxDB container, or from a running InfluxDB. collectd and telegraf
+# write to the influxdb database, cAdvisor to the cadvisor one.
+INFLUXDB_TAR = re.compile(r'influxdb-data' + TAR_EXT)
+INFLUXDB_IMAGE = 'influxdb:1.8'
+INFLUXDB_DATABASES = ['influxdb', 'cadvisor']
+INFLUXDB_TYPES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'ansible', 'roles', 'influxdb', 'files',
+                              'types.db')
+# Measurements of cAdvisor and telegraf that hold cumulative values, they
+# are turned into rates per second like the collectd series whose type is
+# a COUNTER or a DERIVE in types.db
+INFLUXDB_CUMULATIVE = {'cpu_usage_total', 'cpu_usage_system',
+                       'cpu_usage_user', 'cpu_usage_per_cpu', 'rx_bytes',
+                       'rx_errors', 'tx_bytes', 'tx_errors', 'diskio',
+                       'net'}
+METRICS_INDEX = ['db', 'nodes', 'benchmark', 'run', 'scenario',
+                 'measurement', 'host', 'series', 'field', 'elapsed']
 
 
 @doc()
-def full_run(directory, latency, remove_delete,  **kwargs):
+def full_run(directory, latency, remove_delete, stream, chunk_size,
+             no_extract, no_cache, jobs, **kwargs):
     """
 usage: analysis full_run (--directory=directory) [--latency=latency]
                                                  [--remove_delete]
+                                                 [--stream]
+                                                 [--chunk_size=size]
+                                                 [--no_extract]
+                                                 [--no_cache]
+                                                 [--jobs=N]
 
 Full run from a directory
 
     --directory=directory    Path to the result directory
     --latency=latency        The latency for the wanted graph [default: 0]
     --remove_delete          Remove the delete actions from the graphs
+    --stream                 Parse rally reports incrementally instead of
+                             loading them whole in memory
+    --chunk_size=size        Number of atomic actions per chunk in stream
+                             mode [default: 10000]
+    --no_extract             Read the rally reports straight from the
+                             backup tarball instead of extracting them
+    --no_cache               Ignore and do not write the cached tables of
+                             the result directories
+    --jobs=N                 Number of result directories processed in
+                             parallel [default: 1]
+    """
+    store = build_store(directory, remove_delete,
+                        latencies=[int(latency)], stream=stream,
+                        chunk_size=int(chunk_size), no_extract=no_extract,
+                        cache=not no_cache, jobs=int(jobs))
+    _plot(store, int(latency))
+
+
+@doc()
+def percentiles(directory, latency, remove_delete, stream, chunk_size,
+                no_extract, no_cache, jobs, output, **kwargs):
+    """
+usage: analysis percentiles (--directory=directory) [--latency=latency...]
+                                                    [--remove_delete]
+                                                    [--stream]
+                                                    [--chunk_size=size]
+                                                    [--no_extract]
+                                                    [--no_cache]
+                                                    [--jobs=N]
+                                                    [--output=path]
+
+Tail latency (p50, p90, p99, p99.9 and max) of every rally atomic action
+per scenario, db, nodes and latency
+
+    --directory=directory    Path to the result directory
+    --latency=latency        Only keep this latency (every latency if not
+                             given, can be repeated)
+    --remove_delete          Remove the delete actions from the results
+    --stream                 Parse rally reports incrementally instead of
+                             loading them whole in memory
+    --chunk_size=size        Number of atomic actions per chunk in stream
+                             mode [default: 10000]
+    --no_extract             Read the rally reports straight from the
+                             backup tarball instead of extracting them
+    --no_cache               Ignore and do not write the cached tables of
+                             the result directories
+    --jobs=N                 Number of result directories processed in
+                             parallel [default: 1]
+    --output=path            Write the table in csv to path instead of
+                             printing it
+    """
+    latencies = [int(l) for l in latency] or None
+    store = build_store(directory, remove_delete, latencies=latencies,
+                        stream=stream, chunk_size=int(chunk_size),
+                        no_extract=no_extract, cache=not no_cache,
+                        jobs=int(jobs))
+    df = store.query()
+    if df is None:
+        logging.error("No results found in %s" % directory)
+        return
+    df = df[['count', 'duration', 'max'] + [p for p, _ in PERCENTILES]]
+    df = df.rename(columns={'duration': 'mean'})
+    if output:
+        df.to_csv(output)
+    else:
+        with pd.option_context('display.max_rows', None,
+                               'display.max_columns', None,
+                               'display.width', None):
+            print(df)
+
+
+@doc()
+def throughput(directory, latency, window, remove_delete, stream,
+               chunk_size, no_extract, no_cache, jobs, output, **kwargs):
+    """
+usage: analysis throughput (--directory=directory) [--latency=latency...]
+                                                   [--window=seconds]
+                                                   [--remove_delete]
+                                                   [--stream]
+                                                   [--chunk_size=size]
+                                                   [--no_extract]
+                                                   [--no_cache]
+                                                   [--jobs=N]
+                                                   [--output=path]
+
+Throughput (completed top-level actions per second) and number of
+in-flight actions over time, per scenario, db, nodes and latency
+
+    --directory=directory    Path to the result directory
+    --latency=latency        Only keep this latency (every latency if not
+                             given, can be repeated)
+    --window=seconds         Size of the time windows [default: 1]
+    --remove_delete          Remove the delete actions from the results
+    --stream                 Parse rally reports incrementally instead of
+                             loading them whole in memory
+    --chunk_size=size        Number of atomic actions per chunk in stream
+                             mode [default: 10000]
+    --no_extract             Read the rally reports straight from the
+                             backup tarball instead of extracting them
+    --no_cache               Ignore and do not write the cached tables of
+                             the result directories
+    --jobs=N                 Number of result directories processed in
+                             parallel [default: 1]
+    --output=path            Write the series in csv to path instead of
+                             printing them
+    """
+    latencies = [int(l) for l in latency] or None
+    store = build_store(directory, remove_delete, latencies=latencies,
+                        stream=stream, chunk_size=int(chunk_size),
+                        no_extract=no_extract, cache=not no_cache,
+                        jobs=int(jobs),
+                        stages=[throughput_stage(float(window))])
+    df = store.query('throughput')
+    if df is None:
+        logging.error("No results found in %s" % directory)
+        return
+    df = df[['elapsed', 'completed', 'ops_per_s', 'in_flight']]
+    if output:
+        df.to_csv(output)
+    else:
+        with pd.option_context('display.max_rows', None,
+                               'display.max_columns', None,
+                               'display.width', None):
+            print(df)
+
+
+@doc()
+def plot(directory, output_dir, latency, metric, window, remove_delete,
+         stream, chunk_size, no_extract, jobs, format, force, **kwargs):
+    """
+usage: analysis plot (--directory=directory) (--output_dir=directory)
+                     [--latency=latency...] [--metric=metric...]
+                     [--window=seconds] [--remove_delete] [--stream]
+                     [--chunk_size=size] [--no_extract] [--jobs=N]
+                     [--format=format] [--force]
+
+Render one figure per latency, db and metric into files, with a non
+interactive backend. Figures whose cached inputs did not change since
+their last rendering are skipped.
+
+    --directory=directory    Path to the result directory
+    --output_dir=directory   Directory of the figures
+    --latency=latency        Only render this latency (every latency if
+                             not given, can be repeated)
+    --metric=metric          Only render this metric (can be repeated),
+                             one of duration, max, p50, p90, p99, p99.9,
+                             ops_per_s, in_flight (all by default)
+    --window=seconds         Size of the time windows of the ops_per_s
+                             and in_flight metrics [default: 1]
+    --remove_delete          Remove the delete actions from the graphs
+    --stream                 Parse rally reports incrementally instead of
+                             loading them whole in memory
+    --chunk_size=size        Number of atomic actions per chunk in stream
+                             mode [default: 10000]
+    --no_extract             Read the rally reports straight from the
+                             backup tarball instead of extracting them
+    --jobs=N                 Number of worker processes [default: 1]
+    --format=format          File format of the figures [default: png]
+    --force                  Render every figure, even unchanged ones
     """
-    directories = check_directory(directory)
+    jobs = int(jobs)
+    metrics = metric or ACTION_METRICS + THROUGHPUT_METRICS
+    unknown = set(metrics) - set(ACTION_METRICS + THROUGHPUT_METRICS)
+    if unknown:
+        logging.error("Unknown metrics: %s" % ', '.join(sorted(unknown)))
+        return
+    stages = []
+    if set(metrics) & set(ACTION_METRICS):
+        stages.append(ACTIONS)
+    if set(metrics) & set(THROUGHPUT_METRICS):
+        stages.append(throughput_stage(float(window)))
+    latencies = [int(l) for l in latency] or None
+    directories = [result_dir
+                   for result_dir in sorted(check_directory(directory))
+                   if latencies is None or
+                   _dir_key(result_dir).latency in latencies]
+
+    # Only parse the directories that are not cached yet, figures are
+    # then rendered from the cached tables
+    stale = [(result_dir, remove_delete, stream, int(chunk_size),
+              no_extract, True, stages) for result_dir in directories
+             if not all(_cache_valid(result_dir, remove_delete, stage)
+                        for stage in stages)]
+    _map(_process_directory, stale, jobs)
+
+    groups = {}
     for result_dir in directories:
-        unzip_rally(result_dir)
-        add_results(result_dir, latency, remove_delete)
-    _plot(latency)
+        key = _dir_key(result_dir)
+        groups.setdefault((key.latency, key.db), []).append(result_dir)
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, PLOT_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    figures = []
+    for (laten, db), dirs in sorted(groups.items()):
+        for name in metrics:
+            stage = ACTIONS if name in ACTION_METRICS else stages[-1]
+            cached_dirs = [d for d in dirs
+                           if _cache_valid(d, remove_delete, stage)]
+            if not cached_dirs:
+                continue
+            path = os.path.join(output_dir, '%s-%s-%sms.%s'
+                                % (name, db, laten, format))
+            fingerprint = _plot_fingerprint(cached_dirs, remove_delete,
+                                            stage, name)
+            if (not force and os.path.exists(path) and
+                    manifest.get(os.path.basename(path)) == fingerprint):
+                logging.info("%s is up to date" % path)
+                continue
+            figures.append(((path, name, laten, db, cached_dirs,
+                             remove_delete, stage), fingerprint))
+
+    rendered = _map(_render_figure, [args for args, _ in figures], jobs,
+                    initializer=_headless)
+    for (args, fingerprint), ok in zip(figures, rendered):
+        if ok:
+            manifest[os.path.basename(args[0])] = fingerprint
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+    logging.info("Rendered %s figures out of %s" % (sum(rendered),
+                                                    len(figures)))
+
+
+@doc()
+def sysbench(directory, latency, intervals, clients, output, **kwargs):
+    """
+usage: analysis sysbench (--directory=directory) [--latency=latency...]
+                                                 [--intervals]
+                                                 [--clients]
+                                                 [--output=path]
+
+Transactions, queries, errors and reconnects per second and latency of
+every sysbench run, per db, nodes, latency, workload, threads, tables,
+table size, duration and host
+
+    --directory=directory    Path to the result directory
+    --latency=latency        Only keep this latency (every latency if not
+                             given, can be repeated)
+    --intervals              Show the per-interval reports instead of the
+                             final statistics
+    --clients                Show every client of distributed runs
+                             instead of merging them
+    --output=path            Write the table in csv to path instead of
+                             printing it
+    """
+    latencies = [int(l) for l in latency] or None
+    store = build_sysbench_store(directory, latencies=latencies)
+    df = store.query('sysbench_intervals' if intervals else 'sysbench')
+    if df is None:
+        logging.error("No sysbench results found in %s" % directory)
+        return
+    if not clients:
+        df = merge_clients(df)
+    if output:
+        df.to_csv(output)
+    else:
+        with pd.option_context('display.max_rows', None,
+                               'display.max_columns', None,
+                               'display.width', None):
+            print(df)
+
+
+@doc()
+def overlap(directory, latency, output, **kwargs):
+    """
+usage: analysis overlap (--directory=directory) [--latency=latency...]
+                                                [--output=path]
+
+Start, end and duration of every rally scenario, with the time during
+which other scenarios of the same run were running, when scenarios ran
+concurrently (juice rally --parallelism)
+
+    --directory=directory    Path to the result directory
+    --latency=latency        Only keep this latency (every latency if not
+                             given, can be repeated)
+    --output=path            Write the table in csv to path instead of
+                             printing it
+
+The `overlap` column is the time during which at least one other
+scenario was running, `concurrency` the mean number of other scenarios
+running, and `overlapping` lists them.
+    """
+    latencies = [int(l) for l in latency] or None
+    store = ResultStore()
+    for result_dir in sorted(check_directory(directory)):
+        if latencies is None or _dir_key(result_dir).latency in latencies:
+            add_timeline(store, result_dir)
+    df = store.query('timeline')
+    if df is None:
+        logging.error("No rally timeline found in %s" % directory)
+        return
+    if output:
+        df.to_csv(output)
+    else:
+        with pd.option_context('display.max_rows', None,
+                               'display.max_columns', None,
+                               'display.width', None):
+            print(df)
+
+
+@doc()
+def metrics(directory, latency, resolution, measurement, influxdb, no_cache,
+            output, **kwargs):
+    """
+usage: analysis metrics (--directory=directory) [--latency=latency...]
+                                                [--resolution=seconds]
+                                                [--measurement=regex]
+                                                [--influxdb=url]
+                                                [--no_cache]
+                                                [--output=path]
+
+Monitoring data (collectd, cAdvisor, telegraf) of the nodes during every
+rally scenario and sysbench run, downsampled and aligned on the start of
+the run
+
+    --directory=directory    Path to the result directory
+    --latency=latency        Only keep this latency (every latency if not
+                             given, can be repeated)
+    --resolution=seconds     Width of the buckets over which the series
+                             are averaged [default: 10]
+    --measurement=regex      Only keep the measurements matching regex
+                             [default: .*]
+    --influxdb=url           Query this InfluxDB, e.g.,
+                             http://localhost:8086, instead of a stand-in
+                             of the influxdb-data tarball of each result
+                             directory
+    --no_cache               Ignore and do not write the cached tables of
+                             the result directories
+    --output=path            Write the table in csv to path instead of
+                             printing it
+
+The stand-in is a docker container of InfluxDB on the data extracted in
+a temporary folder. Bucket N of a run covers elapsed seconds [N * res,
+(N + 1) * res) after its start, for every scenario container of the
+rally timeline and every sysbench run. Cumulative series (e.g., collectd
+counters, cAdvisor cpu_usage_total) are turned into rates per second.
+    """
+    latencies = [int(l) for l in latency] or None
+    store = build_metrics_store(directory, int(resolution), measurement,
+                                influxdb=influxdb, latencies=latencies,
+                                cache=not no_cache)
+    df = store.query('metrics')
+    if df is None:
+        logging.error("No monitoring data found in %s" % directory)
+        return
+    if output:
+        df.to_csv(output)
+    else:
+        with pd.option_context('display.max_rows', None,
+                               'display.max_columns', None,
+                               'display.width', None):
+            print(df)
+
+
+def _map(fn, args, jobs, initializer=None):
+    """starmap of `fn` on `args`, in a pool of `jobs` processes if > 1"""
+    if jobs > 1 and len(args) > 1:
+        with Pool(jobs, initializer=initializer) as pool:
+            return pool.starmap(fn, args)
+    if initializer is not None:
+        initializer()
+    return [fn(*arg) for arg in args]
+
+
+def _headless():
+    plt.switch_backend('agg')
+
+
+def _plot_fingerprint(directories, remove_delete, stage, metric):
+    """Hash of the cache keys of the inputs of a figure"""
+    sha = hashlib.sha256()
+    sha.update(json.dumps([PLOT_VERSION, metric]).encode())
+    for result_dir in directories:
+        _, key_path = _cache_paths(result_dir, remove_delete, stage)
+        with open(key_path) as f:
+            key = json.load(f)
+        # The mtime can change without the content changing
+        for entry in key.get('tars', []):
+            entry.pop('mtime', None)
+        sha.update(json.dumps([os.path.basename(result_dir),
+                               os.path.basename(key_path), key],
+                              sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def _render_figure(path, metric, latency, db, directories, remove_delete,
+                   stage):
+    """Renders one figure from cached tables (run in a worker)
+
+    Returns whether the figure has been written.
+    """
+    store = ResultStore()
+    for result_dir in directories:
+        table = _read_cache(result_dir, remove_delete, stage)
+        if table is not None:
+            store.add(_dir_key(result_dir), table, kind=stage.kind)
+    if metric in ACTION_METRICS:
+        fig = _actions_figure(store, latency, metric, db=db)
+    else:
+        fig = _series_figure(store, latency, metric, db=db)
+    if fig is None:
+        return False
+    fig.suptitle("%s - %s - %sms" % (metric, db, latency))
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+    logging.info("Rendered %s" % path)
+    return True
+
+
+ResultKey = namedtuple('ResultKey', ['db', 'nodes', 'latency', 'burst'])
+
+
+class ResultStore(object):
+    """Tables of results indexed by (db, nodes, latency, burst)
+
+    The store is built once from the result directories and can then be
+    queried as many times as needed without parsing anything again.
+    `burst` is None for result directories that do not encode it.
+    """
+
+    def __init__(self):
+        self._tables = {}
+
+    def add(self, key, table, kind='actions'):
+        """Adds the `kind` table (e.g., actions, throughput) of `key`"""
+        self._tables[(kind, ResultKey(*key))] = table
+
+    def kinds(self):
+        return sorted(set(kind for kind, _ in self._tables))
+
+    def keys(self, kind='actions', **filters):
+        """Returns the sorted keys of `kind` tables matching `filters`
+
+        Each filter is a field of `ResultKey` with either one value or
+        a list of accepted values.
+        """
+        def accepted(key):
+            for field, wanted in filters.items():
+                if wanted is None:
+                    continue
+                if not isinstance(wanted, (list, tuple, set)):
+                    wanted = [wanted]
+                if getattr(key, field) not in wanted:
+                    return False
+            return True
+        return sorted((k for t, k in self._tables
+                       if t == kind and accepted(k)),
+                      key=lambda k: (k.db, k.nodes, k.latency,
+                                     str(k.burst)))
+
+    def values(self, field, kind='actions', **filters):
+        """Returns the sorted distinct values of `field`"""
+        keys = self.keys(kind, **filters)
+        return sorted(set(getattr(k, field) for k in keys),
+                      key=str if field == 'burst' else None)
+
+    def query(self, kind='actions', **filters):
+        """Concatenates the tables matching `filters`
+
+        The latency and burst of each table are prepended to its index,
+        db and nodes are already part of it. Returns None if no table
+        matches.
+        """
+        keys = self.keys(kind, **filters)
+        if not keys:
+            return None
+        frames = []
+        for k in keys:
+            table = self._tables[(kind, k)]
+            levels = ['latency', 'burst'] + list(table.index.names)
+            frames.append(table.assign(latency=k.latency, burst=k.burst)
+                          .set_index(['latency', 'burst'], append=True)
+                          .reorder_levels(levels))
+        return pd.concat(frames)
+
+    def __len__(self):
+        return len(self._tables)
+
+
+def build_store(directory, remove_delete, latencies=None, stream=False,
+                chunk_size=10000, no_extract=False, cache=True, jobs=1,
+                store=None, stages=None):
+    """Fills a `ResultStore` with the result directories of `directory`
+
+    Only directories whose latency is in `latencies` are processed
+    (all of them if None). Each of the `stages` (only ACTIONS by
+    default) adds its own kind of table. Returns the store.
+    """
+    stages = stages or [ACTIONS]
+    store = ResultStore() if store is None else store
+    # Sorted so that the concatenated tables do not depend on the order
+    # of os.listdir nor on which worker finishes first
+    directories = [result_dir
+                   for result_dir in sorted(check_directory(directory))
+                   if latencies is None or
+                   _dir_key(result_dir).latency in latencies]
+    args = [(result_dir, remove_delete, stream, chunk_size, no_extract,
+             cache, stages) for result_dir in directories]
+    tables = _map(_process_directory, args, jobs)
+    for result_dir, dir_tables in zip(directories, tables):
+        for stage, table in zip(stages, dir_tables):
+            if table is not None:
+                store.add(_dir_key(result_dir), table, kind=stage.kind)
+    return store
+
+
+def _process_directory(directory, remove_delete, stream, chunk_size,
+                       no_extract, cache, stages):
+    """Builds the tables of one result directory (run in a worker)
+
+    Returns one table per stage, all None if there is no rally tarball.
+    """
+    if _find_tar(directory) is None:
+        logging.warning("No rally tarball in %s, skipped" % directory)
+        return [None for _ in stages]
+    if not (no_extract or (cache and all(_cache_valid(directory,
+                                                      remove_delete, stage)
+                                         for stage in stages))):
+        unzip_rally(directory)
+    return [_results_table(directory, remove_delete, stream, chunk_size,
+                           no_extract, cache, stage)
+            for stage in stages]
 
 
 def check_directory(folder, **kwargs):
@@ -86,126 +796,1011 @@ def check_directory(folder, **kwargs):
 
 def unzip_rally(directory, **kwargs):
     tar = _find_tar(directory)
-    ar = tarfile.open(tar)
     results_dir = os.path.join(directory, "results/")
     if not os.path.exists(results_dir):
         os.makedirs(results_dir)
-    ar.extractall(path=results_dir,
-                  members=_safe_json(ar, directory))
-    ar.close()
+    with _open_tar(tar) as ar:
+        ar.extractall(path=results_dir,
+                      members=_safe_json(ar, directory))
     return
 
 
-def _collect_actions(actions, scenario, db, nodes, remove_delete):
-    result = []
-    if db == 'mariadb':
-        db = 'M'
-    elif db == 'cockroachdb':
-        db = 'C'
-    for a in actions:
-        a.update({'scenario': scenario})
-        a.update({'db': db})
-        a.update({'nodes': nodes})
-        if remove_delete:
-            # delete_user makes everything ugly
-            if a.get('name') != 'keystone_v3.delete_user':
-                result.append(a)
-            for suba in _collect_actions(a['children'], scenario,
-                                         db, nodes, remove_delete):
-                if a.get('name') != 'keystone_v3.delete_user':
-                    result.append(suba)
-        else:
-            result.append(a)
-            for suba in _collect_actions(a['children'], scenario,
-                                         db, nodes, remove_delete):
-                result.append(suba)
-    return result
+def _flatten_actions(actions):
+    """Flattens atomic actions and their children in a single pass
+
+    Returns a dict of arrays (name, started_at, finished_at, depth and
+    parent) in pre-order, where `parent` is the position of the parent
+    action or -1 for top-level actions. Parents always come before
+    their children.
+    """
+    names, started, finished, depths, parents = [], [], [], [], []
+    stack = [(a, 0, -1) for a in reversed(actions)]
+    while stack:
+        action, depth, parent = stack.pop()
+        position = len(names)
+        names.append(action.get('name'))
+        started.append(action.get('started_at'))
+        finished.append(action.get('finished_at'))
+        depths.append(depth)
+        parents.append(parent)
+        stack.extend((child, depth + 1, position)
+                     for child in reversed(action.get('children') or []))
+    return {'name': np.array(names, dtype=object),
+            'started_at': np.array(started, dtype=float),
+            'finished_at': np.array(finished, dtype=float),
+            'depth': np.array(depths, dtype=int),
+            'parent': np.array(parents, dtype=int)}
+
+
+def _delete_mask(flat):
+    """Masks out delete_user actions together with all their children"""
+    excluded = flat['name'] == DELETE_ACTION
+    depth = flat['depth']
+    # Level by level, so that parents are settled before their children
+    for level in range(1, depth.max() + 1 if len(depth) else 0):
+        at_level = depth == level
+        excluded[at_level] |= excluded[flat['parent'][at_level]]
+    return ~excluded
+
+
+def _constant(value, length):
+    return pd.Categorical.from_codes(np.zeros(length, dtype=int), [value])
 
 
-def add_results(directory, latency, remove_delete, **kwargs):
+def _actions_frame(actions, scenario, db, nodes, remove_delete):
+    flat = _flatten_actions(actions)
+    if remove_delete:
+        mask = _delete_mask(flat)
+        flat = {k: v[mask] for k, v in flat.items()}
+    length = len(flat['name'])
+    df = pd.DataFrame({
+        'name': pd.Categorical(flat['name']),
+        'started_at': flat['started_at'],
+        'finished_at': flat['finished_at'],
+        'depth': flat['depth'],
+        'duration': flat['finished_at'] - flat['started_at'],
+        'scenario': _constant(scenario, length),
+        'db': _constant(DB_LABELS.get(db, db), length),
+        'nodes': _constant(nodes, length)})
+    return df
+
+
+def _partial_table(df):
+    """Summarises the durations of a frame of actions per action
+
+    Returns the sum, count and max of the durations and their sketch,
+    i.e., the number of durations in each logarithmic bucket. Partial
+    tables of several chunks are combined with `_merge_partials`.
+    """
+    groups = df.groupby(TABLE_INDEX, observed=True)['duration']
+    stats = groups.agg(['sum', 'count', 'max'])
+    durations = df['duration'].to_numpy()
+    known = ~np.isnan(durations)
+    buckets = np.ceil(np.log(np.maximum(durations[known], SKETCH_MIN)) /
+                      math.log(SKETCH_GAMMA)).astype(int)
+    sketch = (df.loc[known, TABLE_INDEX].assign(bucket=buckets)
+              .groupby(TABLE_INDEX + ['bucket'], observed=True).size())
+    return stats, sketch
+
+
+def _merge_partials(left, right):
+    if left is None:
+        return right
+    stats = left[0][['sum', 'count']].add(right[0][['sum', 'count']],
+                                          fill_value=0)
+    stats['max'] = pd.concat([left[0]['max'], right[0]['max']],
+                             axis=1).max(axis=1)
+    return stats, left[1].add(right[1], fill_value=0)
+
+
+def _sketch_percentiles(sketch):
+    """Estimates PERCENTILES of each action from its sketch
+
+    The estimate of a bucket is the middle of its bounds, that is
+    within SKETCH_ACCURACY of any duration in it.
+    """
+    sketch = sketch.sort_index()
+    groups = sketch.groupby(level=TABLE_INDEX)
+    seen = groups.cumsum()
+    total = groups.transform('sum')
+    buckets = sketch.index.get_level_values('bucket').to_numpy()
+    estimates = pd.Series(2 * SKETCH_GAMMA ** buckets / (SKETCH_GAMMA + 1),
+                          index=sketch.index)
+    result = {}
+    for name, q in PERCENTILES:
+        # First bucket where the rank of the percentile is reached
+        reached = seen > q * (total - 1)
+        result[name] = estimates[reached].groupby(level=TABLE_INDEX).first()
+    return pd.DataFrame(result)
+
+
+def _final_table(partial):
+    stats, sketch = partial
+    table = (stats['sum'] / stats['count']).to_frame('duration')
+    table['count'] = stats['count'].astype(int)
+    table['max'] = stats['max']
+    table = table.join(_sketch_percentiles(sketch))
+    # Bucket estimates may overshoot the exact max by SKETCH_ACCURACY
+    for name, _ in PERCENTILES:
+        table[name] = table[name].clip(upper=table['max'])
+    return _plain_index(table)
+
+
+def _plain_index(table):
+    # Back to plain levels, categories differ from one report to another
+    names = list(table.index.names)
+    table.index = pd.MultiIndex.from_arrays(
+        [table.index.get_level_values(level).astype(object)
+         if level != 'time' else table.index.get_level_values(level)
+         for level in names], names=names)
+    return table
+
+
+def _throughput_partial(df, window):
+    """Completions and busy time of top-level actions per time window
+
+    Windows are `window` seconds long and aligned on the epoch, so that
+    the partial series of several chunks add up. They are indexed by
+    their number since the epoch rather than by their start time, which
+    is not exact with a fractional `window`. The busy time of a window is
+    the time spent in it by all the actions running during the window,
+    i.e., the integral of the number of in-flight actions.
+    """
+    top = df[(df['depth'] == 0) &
+             df['started_at'].notna() & df['finished_at'].notna()]
+    if top.empty:
+        return None
+    started = top['started_at'].to_numpy()
+    finished = top['finished_at'].to_numpy()
+    first = math.floor(started.min() / window)
+    last = math.floor(finished.max() / window)
+    # Relative to the first window, to keep precision in the sums below
+    origin = first * window
+    # Numbered like `last`, so that no action falls after it
+    completed = np.bincount(np.floor(finished / window).astype(int) - first,
+                            minlength=last - first + 1)
+    started = np.sort(started - origin)
+    finished = np.sort(finished - origin)
+    bounds = np.arange(last - first + 2) * window
+    busy = np.diff(_busy_time(started, bounds) -
+                   _busy_time(finished, bounds))
+    scenario, db, nodes = (top[c].iloc[0] for c in ['scenario', 'db',
+                                                    'nodes'])
+    index = pd.MultiIndex.from_product(
+        [[scenario], [db], [nodes], np.arange(first, last + 1)],
+        names=SERIES_INDEX)
+    return pd.DataFrame({'completed': completed, 'busy': busy},
+                        index=index)
+
+
+def _busy_time(times, bounds):
+    """Sums `bound - t` over the sorted `times` before each bound"""
+    before = np.searchsorted(times, bounds)
+    sums = np.concatenate([[0], np.cumsum(times)])
+    return before * bounds - sums[before]
+
+
+def _merge_throughput(left, right):
+    if left is None or right is None:
+        return right if left is None else left
+    return left.add(right, fill_value=0)
+
+
+def _throughput_table(totals, window):
+    # Windows idle between the ranges of two chunks are missing
+    numbers = totals.index.get_level_values('time')
+    series = totals.index.droplevel('time').unique()
+    totals = totals.reindex(pd.MultiIndex.from_tuples(
+        [key + (number,) for key in series
+         for number in range(numbers.min(), numbers.max() + 1)],
+        names=totals.index.names), fill_value=0)
+    table = pd.DataFrame({'ops_per_s': totals['completed'] / window,
+                          'in_flight': totals['busy'] / window},
+                         index=totals.index)
+    table['completed'] = totals['completed'].astype(int)
+    # Window numbers to start times, rounded to the decimals of `window`
+    # since e.g. 5000000007 * 0.3 is 1500000002.1999998
+    decimals = max(0, -decimal.Decimal(repr(float(window))).normalize()
+                   .as_tuple().exponent)
+    numbers = table.index.get_level_values('time')
+    table['elapsed'] = np.round((numbers - numbers.min()) * window, decimals)
+    table.index = table.index.set_levels(
+        np.round(table.index.levels[table.index.names.index('time')] *
+                 window, decimals),
+        level='time')
+    return _plain_index(table.sort_index())
+
+
+# How a kind of table is computed from the atomic actions of a report:
+# `partial` summarises a chunk of actions (a data frame), `merge`
+# combines two summaries and `final` turns the summary of the whole
+# report into the table. `name` tells apart the cached tables.
+Stage = namedtuple('Stage', ['kind', 'name', 'partial', 'merge', 'final'])
+
+ACTIONS = Stage('actions', 'actions', _partial_table, _merge_partials,
+                _final_table)
+
+
+def throughput_stage(window):
+    """Stage of the throughput over time, in windows of `window` seconds"""
+    return Stage('throughput', 'throughput-%gs' % window,
+                 partial(_throughput_partial, window=window),
+                 _merge_throughput,
+                 partial(_throughput_table, window=window))
+
+
+def _scenario(title):
+    scenario = title.split('.')[1]
+    if scenario not in KEY_SCENARIOS:
+        return None
+    return scenario
+
+
+def _load_table(fileopen, db, nodes, remove_delete, stage):
+    json_file = json.load(fileopen)
+    subtask = json_file['tasks'][0]['subtasks'][0]
+    scenario = _scenario(subtask['title'])
+    if scenario is None:
+        return None
+    data = subtask['workloads'][0]['data']
+    actions = []
+    for v in data:
+        for a in v['atomic_actions']:
+            actions.append(a)
+    less_is_better = _actions_frame(actions, scenario, db, nodes,
+                                    remove_delete)
+    totals = stage.partial(less_is_better)
+    if totals is None:
+        return None
+    return stage.final(totals)
+
+
+def _stream_title(events):
+    """Returns the title of the first subtask of a rally report
+
+    Consumes `events` only up to the title. Rally writes the title of a
+    subtask before its workloads, so the same event iterator can then
+    be handed to `_stream_actions`.
+    """
+    for prefix, event, value in events:
+        if prefix == TITLE_PREFIX:
+            return value
+    return None
+
+
+def _stream_actions(events, chunk_size):
+    """Lazily walks tasks[0].subtasks[0].workloads[0].data[*].atomic_actions
+
+    Yields lists of at most `chunk_size` top-level atomic actions (with
+    their children), so that only one chunk of the report is held in
+    memory at a time.
+    """
+    chunk = []
+    builder = None
+    for prefix, event, value in events:
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == ACTION_PREFIX and event == 'end_map':
+                chunk.append(builder.value)
+                builder = None
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        elif prefix == ACTION_PREFIX and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == WORKLOAD_PREFIX and event == 'end_map':
+            # Only the first workload of the first subtask is analysed
+            break
+    if chunk:
+        yield chunk
+
+
+def _stream_table(fileopen, db, nodes, remove_delete, chunk_size, stage):
+    # A single pass over the report: it never seeks, so it also works
+    # on members read sequentially from a tarball
+    events = ijson.parse(fileopen, use_float=True)
+    title = _stream_title(events)
+    if title is None or _scenario(title) is None:
+        return None
+    scenario = _scenario(title)
+    # Statistics are rebuilt from mergeable partial tables, so that
+    # chunks can be dropped as soon as they are processed
+    totals = None
+    for actions in _stream_actions(events, chunk_size):
+        df = _actions_frame(actions, scenario, db, nodes, remove_delete)
+        totals = stage.merge(totals, stage.partial(df))
+    if totals is None:
+        return None
+    return stage.final(totals)
+
+
+def _iter_reports(directory):
     results = os.path.join(directory, "results")
-    dir_name = os.path.basename(directory)
     for fil in os.listdir(results):
         file_path = os.path.join(results, fil)
-        with open(file_path, "r") as fileopen:
-            json_file = json.load(fileopen)
-            subtask = json_file['tasks'][0]['subtasks'][0]
-            scenario = subtask['title'].split('.')[1]
-            key_scenarios = ['authenticate_user_and_validate_token',
-                             'create_add_and_list_user_roles',
-                             'create_and_list_tenants',
-                             'get_entities',
-                             'create_user_update_password',
-                             'create_user_set_enabled_and_delete',
-                             'create_and_list_users']
-            if (scenario not in key_scenarios):
-                continue
-            db = dir_name.split('-', 1)[0]
-            nodes = dir_name.split('-')[1]
-            laten = dir_name.split('-')[2].split('ms')[0]
-            if laten == latency:
-                data = subtask['workloads'][0]['data']
-                actions = []
-                for v in data:
-                    for a in v['atomic_actions']:
-                        actions.append(a)
-                all_actions = _collect_actions(actions,
-                                               scenario,
-                                               db,
-                                               nodes,
-                                               remove_delete)
-                df = pd.DataFrame(all_actions, columns=['name',
-                                                        'started_at',
-                                                        'finished_at',
-                                                        'scenario',
-                                                        'db',
-                                                        'nodes'])
-                df['duration'] = df['finished_at'].subtract(df['started_at'])
-                less_is_better = df.drop(columns=['finished_at',
-                                                  'started_at'])
-                table = pd.pivot_table(less_is_better,
-                                       values='duration',
-                                       index=['scenario',
-                                              'db',
-                                              'nodes',
-                                              'name'])
-                if laten == '0':
-                    DF_0.append(table)
-                elif laten == '50':
-                    DF_50.append(table)
-                elif laten == '150':
-                    DF_150.append(table)
+        with open(file_path, "rb") as fileopen:
+            yield fileopen
+
+
+def _iter_tar_reports(directory):
+    """Yields the rally json reports straight from the backup tarball
+
+    Members go through the same checks as `unzip_rally` but are read
+    sequentially from the archive, without writing anything to disk.
+    """
+    with _open_tar(_find_tar(directory)) as ar:
+        for finfo in _safe_json(ar, directory):
+            fileopen = ar.extractfile(finfo)
+            if fileopen is not None:
+                yield fileopen
+
+
+def _directory_table(directory, db, nodes, remove_delete, stream,
+                     chunk_size, from_tar, stage):
+    tables = []
+    reports = _iter_tar_reports if from_tar else _iter_reports
+    for fileopen in reports(directory):
+        if stream:
+            table = _stream_table(fileopen, db, nodes, remove_delete,
+                                  chunk_size, stage)
+        else:
+            table = _load_table(fileopen, db, nodes, remove_delete, stage)
+        if table is not None:
+            tables.append(table)
+    if not tables:
+        return None
+    # Reports come in tarball or directory listing order
+    return pd.concat(tables).sort_index()
+
+
+def _cache_paths(directory, remove_delete, stage):
+    name = 'rally-' + stage.name
+    if remove_delete:
+        name += '-remove_delete'
+    cache_dir = os.path.join(directory, CACHE_DIR)
+    return (os.path.join(cache_dir, name + '.parquet'),
+            os.path.join(cache_dir, name + '.json'))
+
+
+def _file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _cache_key(tars, digest=False):
+    key = {'version': CACHE_VERSION, 'tars': []}
+    for tar in tars:
+        stat = os.stat(tar)
+        entry = {'tar': os.path.basename(tar),
+                 'size': stat.st_size,
+                 'mtime': stat.st_mtime}
+        if digest:
+            entry['sha256'] = _file_hash(tar)
+        key['tars'].append(entry)
+    return key
+
+
+def _cache_valid(directory, remove_delete, stage):
+    """Tells whether the cached table of `directory` is up to date
+
+    The cache is keyed by the size, mtime and sha256 of the rally
+    tarball. The hash is only computed when the mtime changed, e.g.,
+    after copying the backup somewhere else.
+    """
+    tar = _find_tar(directory)
+    if tar is None:
+        return False
+    table_path, key_path = _cache_paths(directory, remove_delete, stage)
+    return _table_valid(table_path, key_path, [tar])
+
+
+def _table_valid(table_path, key_path, tars):
+    """Tells whether the table cached from `tars` is up to date"""
+    if not (os.path.exists(table_path) and os.path.exists(key_path)):
+        return False
+    with open(key_path) as f:
+        cached_key = json.load(f)
+    key = _cache_key(tars)
+    cached = cached_key.get('tars') or []
+    if (key['version'] != cached_key.get('version') or
+            len(key['tars']) != len(cached) or
+            any(entry[k] != old.get(k)
+                for entry, old in zip(key['tars'], cached)
+                for k in ['tar', 'size'])):
+        return False
+    if any(entry['mtime'] != old.get('mtime')
+           for entry, old in zip(key['tars'], cached)):
+        key = _cache_key(tars, digest=True)
+        if any(entry['sha256'] != old.get('sha256')
+               for entry, old in zip(key['tars'], cached)):
+            return False
+        _write_key(key_path, key)
+    return True
+
+
+def _read_cache(directory, remove_delete, stage):
+    if not _cache_valid(directory, remove_delete, stage):
+        return None
+    table_path, _ = _cache_paths(directory, remove_delete, stage)
+    return pd.read_parquet(table_path)
+
+
+def _write_key(key_path, key):
+    tmp_path = key_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(key, f)
+    os.replace(tmp_path, key_path)
+
+
+def _write_cache(directory, remove_delete, stage, table):
+    table_path, key_path = _cache_paths(directory, remove_delete, stage)
+    _write_table(table_path, key_path, [_find_tar(directory)], table)
+
+
+def _write_table(table_path, key_path, tars, table):
+    os.makedirs(os.path.dirname(table_path), exist_ok=True)
+    key = _cache_key(tars, digest=True)
+    tmp_path = table_path + '.tmp'
+    table.to_parquet(tmp_path)
+    os.replace(tmp_path, table_path)
+    _write_key(key_path, key)
+
+
+def _dir_key(directory):
+    """Returns the `ResultKey` encoded in a result directory name
+
+    Names are <db>-<nodes>-<latency>[ms][-<T|F>], the last part telling
+    whether rally ran in burst mode.
+    """
+    parts = os.path.basename(directory).split('-')
+    burst = None
+    if len(parts) > 3:
+        burst = parts[3].startswith('T')
+    return ResultKey(db=parts[0],
+                     nodes=int(parts[1]),
+                     latency=int(parts[2].split('ms')[0]),
+                     burst=burst)
+
+
+def _results_table(directory, remove_delete, stream, chunk_size, from_tar,
+                   cache, stage=None):
+    stage = stage or ACTIONS
+    table = _read_cache(directory, remove_delete, stage) if cache else None
+    if table is None:
+        key = _dir_key(directory)
+        table = _directory_table(directory, key.db, str(key.nodes),
+                                 remove_delete,
+                                 stream, chunk_size, from_tar, stage)
+        if table is not None and cache:
+            _write_cache(directory, remove_delete, stage, table)
+    return table
+
+
+def add_results(store, directory, remove_delete, stream=False,
+                chunk_size=10000, from_tar=False, cache=False, stage=None,
+                **kwargs):
+    stage = stage or ACTIONS
+    table = _results_table(directory, remove_delete, stream, chunk_size,
+                           from_tar, cache, stage)
+    if table is not None:
+        store.add(_dir_key(directory), table, kind=stage.kind)
     return
 
 
-def _plot(latency):
-    if latency == '0':
-        df = DF_0
-    elif latency == '50':
-        df = DF_50
-    elif latency == '150':
-        df = DF_150
+def build_sysbench_store(directory, latencies=None, store=None):
+    """Adds the sysbench tables of the result directories of `directory`
+
+    Each result directory adds a `sysbench` table (final statistics of
+    each run) and a `sysbench_intervals` table (reports of each run over
+    time). Returns the store.
+    """
+    store = ResultStore() if store is None else store
+    for result_dir in sorted(check_directory(directory)):
+        key = _dir_key(result_dir)
+        if latencies is None or key.latency in latencies:
+            add_sysbench(store, result_dir)
+    return store
+
+
+def add_sysbench(store, directory):
+    key = _dir_key(directory)
+    stats, intervals = [], []
+    for tar in _find_sysbench_tars(directory):
+        host = SYSBENCH_TAR.search(tar).group('host')
+        for tags, lines, _ in _iter_sysbench_logs(tar):
+            run_stats, run_intervals = _parse_sysbench(lines)
+            index = _sysbench_index(tags, run_stats, run_intervals)
+            index.update({'db': DB_LABELS.get(key.db, key.db),
+                          'nodes': str(key.nodes), 'host': host})
+            if run_stats:
+                run_stats.update(index)
+                stats.append(run_stats)
+            else:
+                logging.warning("No final statistics in %s of %s"
+                                % (tags['run'], tar))
+            for interval in run_intervals:
+                interval.update(index)
+                intervals.append(interval)
+    if stats:
+        store.add(key, pd.DataFrame(stats).set_index(SYSBENCH_INDEX)
+                  .sort_index(), kind='sysbench')
+    if intervals:
+        store.add(key, pd.DataFrame(intervals)
+                  .set_index(SYSBENCH_INDEX + ['time']).sort_index(),
+                  kind='sysbench_intervals')
+
+
+def _find_sysbench_tars(directory):
+    """Sysbench tarballs of the backup folder, or of its sub folders"""
+    tars = []
+    for root, _, files in os.walk(os.path.join(directory, 'backup')):
+        tars.extend(os.path.join(root, f) for f in files
+                    if SYSBENCH_TAR.match(f))
+    return sorted(tars)
+
 
+def _iter_sysbench_logs(tar):
+    """Yields (tags, lines, mtime) of the sysbench reports of `tar`
+
+    `tags` are the groups of SYSBENCH_LOG in the name of the report,
+    `mtime` is when sysbench last wrote to it, i.e., the end of the run.
+
+    Reports are read sequentially from the archive, without extracting
+    them.
+    """
+    with _open_tar(tar) as ar:
+        for finfo in ar:
+            match = SYSBENCH_LOG.match(os.path.basename(finfo.name))
+            if not (finfo.isfile() and match):
+                continue
+            content = ar.extractfile(finfo).read()
+            lines = content.decode(errors='replace').splitlines()
+            yield match.groupdict(), lines, finfo.mtime
+
+
+def merge_clients(df):
+    """Merges the clients (hosts) of each sysbench run
+
+    Clients of a distributed run share their run id, so this gives one
+    cluster-wide row per run and per interval, whose `threads` is the
+    total over the clients. The number of merged clients is in the
+    `clients` column.
+    """
+    names = [name for name in df.index.names if name != 'host']
+    levels = [name for name in names if name != 'threads']
+    df = df.reset_index('threads')
+    aggs = dict((column, 'sum' if column in SYSBENCH_SUMS else
+                 'min' if column == 'lat_min' else 'max')
+                for column in df.columns)
+    grouped = df.groupby(level=levels, dropna=False, sort=True)
+    merged = grouped.agg(aggs)
+    # Unknown when no client reported its thread count
+    merged['threads'] = grouped['threads'].sum(min_count=1)
+    merged['clients'] = grouped.size()
+    if 'lat_avg' in merged:
+        merged['lat_avg'] = merged['lat_sum'] / merged['events']
+    return (merged.set_index('threads', append=True).reorder_levels(names)
+            .sort_index())
+
+
+def _sysbench_index(tags, stats, intervals):
+    """Parameters of a run from the tags of its report
+
+    The thread count of untagged reports is read from the report.
+    """
+    if tags['workload'] is None:
+        index = dict(SYSBENCH_UNTAGGED)
+        threads = stats.get('threads')
+        if threads is None and intervals:
+            threads = intervals[0]['threads']
+        index['threads'] = None if threads is None else int(threads)
+    else:
+        index = dict((k, tags[k] if k == 'workload' else int(tags[k]))
+                     for k in ['workload', 'threads', 'tables',
+                               'table_size', 'duration'])
+    index['run'] = tags['run']
+    return index
+
+
+def _parse_sysbench(lines):
+    """Parses the text output of `sysbench ... run`
+
+    Returns the final statistics as a dict (empty if the run did not
+    finish) and the list of per-interval reports, each one a dict.
+    Latencies are in milliseconds and the latency percentile gives its
+    name to the column, e.g., lat_p95.
+    """
+    stats, intervals = {}, []
+    for line in lines:
+        match = SYSBENCH_INTERVAL.search(line)
+        if match:
+            interval = match.groupdict()
+            percentile = interval.pop('percentile')
+            interval['lat_p%g' % float(percentile)] = interval.pop('latency')
+            intervals.append(dict((k, float(v))
+                                  for k, v in interval.items()))
+            continue
+        match = SYSBENCH_STAT.match(line)
+        if not match:
+            continue
+        label = match.group('label').lower()
+        percentile = SYSBENCH_PERCENTILE.match(label)
+        if percentile:
+            column = 'lat_p%g' % float(percentile.group('percentile'))
+        elif label in SYSBENCH_STATS:
+            column = SYSBENCH_STATS[label]
+        else:
+            continue
+        stats[column] = float(match.group('value'))
+        if match.group('rate') is not None:
+            rate = SYSBENCH_RATES.get(column, column + '_per_s')
+            stats[rate] = float(match.group('rate'))
+    # The options are printed at the beginning even if the run failed
+    if 'transactions' not in stats:
+        return {}, intervals
+    return stats, intervals
+
+
+def add_timeline(store, directory):
+    """Adds the `timeline` table of the rally scenarios of `directory`"""
+    tar = _find_tar(directory)
+    if tar is None:
+        return
+    containers = pd.DataFrame(list(_iter_timeline(tar)))
+    if containers.empty:
+        return
+    key = _dir_key(directory)
+    tables = [_overlap_table(run)
+              for _, run in containers.groupby('run', sort=True)]
+    table = pd.concat(tables)
+    table['db'] = DB_LABELS.get(key.db, key.db)
+    table['nodes'] = str(key.nodes)
+    store.add(key, table.set_index(TIMELINE_INDEX).sort_index(),
+              kind='timeline')
+
+
+def _iter_timeline(tar):
+    """Yields the scenario containers recorded in the rally tarball"""
+    with _open_tar(tar) as ar:
+        for finfo in ar:
+            match = TIMELINE.match(os.path.basename(finfo.name))
+            if not (finfo.isfile() and match):
+                continue
+            for line in ar.extractfile(finfo):
+                if not line.strip():
+                    continue
+                container = json.loads(line.decode())
+                labels = container['Config']['Labels'] or {}
+                # e.g., keystone/create-and-list-users.yaml
+                scenario = os.path.basename(labels['juice.scenario'])
+                yield {'run': match.group('run'),
+                       'scenario': (os.path.splitext(scenario)[0]
+                                    .replace('-', '_')),
+                       'started': pd.Timestamp(
+                           container['State']['StartedAt']),
+                       'finished': pd.Timestamp(
+                           container['State']['FinishedAt']),
+                       'exit_code': container['State']['ExitCode']}
+
+
+def _overlap_table(containers):
+    """Overlap of each scenario container with the others of its run"""
+    origin = containers['started'].min()
+    started, finished = ((containers[c] - origin).dt.total_seconds()
+                         .to_numpy() for c in ['started', 'finished'])
+    duration = finished - started
+    overlap, concurrency, overlapping = [], [], []
+    for i in range(len(containers)):
+        # Parts of the other containers that ran during container i
+        starts = np.maximum(started, started[i])
+        ends = np.minimum(finished, finished[i])
+        others = (ends > starts) & (np.arange(len(containers)) != i)
+        overlap.append(_union_length(starts[others], ends[others]))
+        concurrency.append((ends[others] - starts[others]).sum() /
+                           duration[i] if duration[i] > 0 else 0.0)
+        overlapping.append(','.join(sorted(
+            containers['scenario'].to_numpy()[others])))
+    return containers.assign(duration=duration, overlap=overlap,
+                             concurrency=concurrency,
+                             overlapping=overlapping)
+
+
+def _union_length(starts, ends):
+    """Total length of the union of the [start, end] intervals"""
+    total, reach = 0.0, -np.inf
+    for start, end in sorted(zip(starts, ends)):
+        if end > reach:
+            total += end - max(start, reach)
+            reach = end
+    return total
+
+
+def build_metrics_store(directory, resolution, measurement='.*',
+                        influxdb=None, latencies=None, cache=True,
+                        store=None):
+    """Adds the `metrics` tables of the result directories of `directory`
+
+    Series are read from the `influxdb` url, or from a stand-in InfluxDB
+    of the influxdb-data tarball of each result directory. Only the
+    stand-in tables are cached, a running InfluxDB may still get data.
+    Returns the store.
+    """
+    store = ResultStore() if store is None else store
+    for result_dir in sorted(check_directory(directory)):
+        key = _dir_key(result_dir)
+        if latencies is None or key.latency in latencies:
+            add_metrics(store, result_dir, resolution, measurement,
+                        influxdb=influxdb, cache=cache)
+    return store
+
+
+def add_metrics(store, directory, resolution, measurement='.*',
+                influxdb=None, cache=True):
+    tar = None if influxdb else _find_influxdb_tar(directory)
+    if influxdb is None and tar is None:
+        logging.warning("No influxdb-data tarball in %s" % directory)
+        return
+    if tar is not None:
+        # The windows come from the rally and sysbench tarballs, re-running
+        # a benchmark changes them
+        rally_tar = _find_tar(directory)
+        tars = ([tar] + ([] if rally_tar is None else [rally_tar]) +
+                _find_sysbench_tars(directory))
+        table_path, key_path = _metrics_cache_paths(directory, resolution,
+                                                    measurement)
+        if cache and _table_valid(table_path, key_path, tars):
+            store.add(_dir_key(directory), pd.read_parquet(table_path),
+                      kind='metrics')
+            return
+
+    windows = _benchmark_windows(directory)
+    if not windows:
+        logging.warning("No rally timeline nor sysbench run in %s"
+                        % directory)
+        return
+    with _influxdb(influxdb, tar) as url:
+        tables = [_metrics_table(url, database, windows, resolution,
+                                 measurement)
+                  for database in INFLUXDB_DATABASES]
+    tables = [table for table in tables if table is not None]
+    if not tables:
+        return
+    key = _dir_key(directory)
+    table = pd.concat(tables)
+    table['db'] = DB_LABELS.get(key.db, key.db)
+    table['nodes'] = str(key.nodes)
+    table = table.set_index(METRICS_INDEX).sort_index()
+    if tar is not None and cache:
+        _write_table(table_path, key_path, tars, table)
+    store.add(key, table, kind='metrics')
+
+
+def _metrics_cache_paths(directory, resolution, measurement):
+    name = 'metrics-%ds-%s' % (resolution, hashlib.sha256(
+        measurement.encode()).hexdigest()[:12])
+    cache_dir = os.path.join(directory, CACHE_DIR)
+    return (os.path.join(cache_dir, name + '.parquet'),
+            os.path.join(cache_dir, name + '.json'))
+
+
+def _find_influxdb_tar(directory):
+    """influxdb-data tarball of the backup folder, or of its sub folders"""
+    for root, _, files in sorted(os.walk(os.path.join(directory,
+                                                      'backup'))):
+        for f in sorted(files):
+            if INFLUXDB_TAR.match(f):
+                return os.path.join(root, f)
+    return None
+
+
+def _benchmark_windows(directory):
+    """(benchmark, run, scenario, start, end) of the runs of `directory`
+
+    Windows are the scenario containers of the rally timeline and the
+    sysbench runs, in seconds since the epoch. The clients of a
+    distributed sysbench run make a single window.
+    """
+    windows = {}
+    tar = _find_tar(directory)
+    if tar is not None:
+        for container in _iter_timeline(tar):
+            windows[('rally', container['run'], container['scenario'])] = (
+                container['started'].timestamp(),
+                container['finished'].timestamp())
+    for tar in _find_sysbench_tars(directory):
+        for tags, lines, mtime in _iter_sysbench_logs(tar):
+            stats, _ = _parse_sysbench(lines)
+            duration = stats.get('time') or float(
+                tags['duration'] or SYSBENCH_UNTAGGED['duration'])
+            name = ('sysbench', tags['run'],
+                    tags['workload'] or SYSBENCH_UNTAGGED['workload'])
+            start, end = windows.get(name, (mtime - duration, mtime))
+            windows[name] = (min(start, mtime - duration), max(end, mtime))
+    return [name + windows[name] for name in sorted(windows)]
+
+
+@contextmanager
+def _influxdb(url, tar):
+    """Yields `url`, or the one of a stand-in InfluxDB of `tar`
+
+    The data of `tar` is extracted in a temporary folder, removed with the
+    stand-in at the end of the block.
+    """
+    if url is not None:
+        yield url.rstrip('/')
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with _open_tar(tar) as ar:
+            ar.extractall(path=tmp_dir, members=_safe_members(ar, tmp_dir))
+        data_dir = os.path.join(tmp_dir, 'influxdb-data')
+        container = subprocess.check_output(
+            ['docker', 'run', '--detach', '--rm',
+             '--publish', '127.0.0.1::8086',
+             '--volume', '%s:/var/lib/influxdb' % resolved(data_dir),
+             INFLUXDB_IMAGE]).decode().strip()
+        try:
+            port = subprocess.check_output(
+                ['docker', 'port', container, '8086']
+            ).decode().split(':')[-1]
+            url = 'http://127.0.0.1:%s' % port.strip()
+            _wait_influxdb(url)
+            yield url
+        finally:
+            subprocess.call(['docker', 'rm', '--force', container],
+                            stdout=subprocess.DEVNULL)
+
+
+def _wait_influxdb(url, timeout=120):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url + '/ping', timeout=5):
+                return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+
+
+def _metrics_table(url, database, windows, resolution, measurement):
+    """Series of `database` during `windows`, one value per row
+
+    Every window is a query of the same request. Buckets are aligned on
+    the start of their window, with one more bucket before it from which
+    the first rate of the cumulative series is computed.
+    """
+    queries = []
+    for _, _, _, start, end in windows:
+        start = int(math.floor(start)) - resolution
+        queries.append(
+            'SELECT mean(*) FROM /%s/ WHERE time >= %ds AND time < %ds '
+            'GROUP BY time(%ds, %ds), *'
+            % (measurement.replace('/', r'\/'), start, int(math.ceil(end)),
+               resolution, start % resolution))
+    data = urllib.parse.urlencode({'db': database, 'epoch': 's',
+                                   'q': ';\n'.join(queries)}).encode()
+    with urllib.request.urlopen(url + '/query', data) as response:
+        results = json.loads(response.read().decode())['results']
+
+    cumulative = _cumulative_types()
+    frames = []
+    for (benchmark, run, scenario, start, _), result in zip(windows,
+                                                            results):
+        if 'error' in result:
+            logging.warning("%s of %s %s: %s" % (database, benchmark, run,
+                                                 result['error']))
+            continue
+        origin = int(math.floor(start))
+        for series in result.get('series', []):
+            frame = _series_frame(series, origin, cumulative)
+            if frame is not None:
+                frames.append(frame.assign(benchmark=benchmark, run=run,
+                                           scenario=scenario))
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+
+def _series_frame(series, origin, cumulative):
+    """One row per field and bucket of an InfluxDB series
+
+    The host is the host tag (collectd, telegraf) or the machine one
+    (cAdvisor), the other tags make the series column.
+    """
+    tags = dict((k, v) for k, v in series.get('tags', {}).items() if v)
+    host = tags.pop('host', tags.pop('machine', ''))
+    name = series['name']
+    df = pd.DataFrame(series['values'], columns=series['columns'])
+    df = df.set_index('time')
+    if (name in INFLUXDB_CUMULATIVE or
+            (tags.get('type'), name.rsplit('_', 1)[-1]) in cumulative):
+        df = df.diff().div(df.index.to_series().diff(), axis=0)
+        # Counters go back to zero when their source restarts
+        df = df.mask(df < 0)
+    df = df[df.index >= origin]
+    df = df.reset_index().melt(id_vars='time', var_name='field').dropna()
+    if df.empty:
+        return None
+    # Columns of mean(*) are mean_<field>
+    return df.assign(field=df['field'].str.replace('^mean_', '', regex=True),
+                     elapsed=df['time'] - origin,
+                     time=pd.to_datetime(df['time'], unit='s'),
+                     measurement=name, host=host,
+                     series=','.join('%s=%s' % (k, tags[k])
+                                     for k in sorted(tags)))
+
+
+def _cumulative_types():
+    """(type, data source) of the COUNTER and DERIVE series of collectd"""
+    cumulative = set()
+    with open(INFLUXDB_TYPES) as f:
+        for line in f:
+            fields = line.split(None, 1)
+            if len(fields) != 2 or fields[0].startswith('#'):
+                continue
+            for source in fields[1].split(','):
+                name, kind = source.strip().split(':')[:2]
+                if kind in ('COUNTER', 'DERIVE'):
+                    cumulative.add((fields[0], name))
+    return cumulative
+
+
+def _plot(store, latency):
+    if _actions_figure(store, latency) is not None:
+        plt.show()
+
+
+def _actions_figure(store, latency, metric='duration', db=None):
+    """Stacked bars of `metric` for each action, per scenario and nodes"""
     # Concatenate all data frames
-    df = pd.concat(df)
+    df = store.query(latency=latency, db=db)
+    if df is None:
+        logging.error("No results with a latency of %sms" % latency)
+        return None
+    df = df[[metric]]
+    df = df.droplevel('latency')
+    if len(df.index.unique('burst')) == 1:
+        df = df.droplevel('burst')
 
     # Extract nodes as columns
     df = df.unstack()
 
     # Re-order by nodes (else the order is '25' '3' '45' lexicographically)
-    df = df.reindex(pd.Index(['3', '25', '45'], name='nodes'), level=2)
+    nodes = sorted(df.index.unique('nodes'), key=int)
+    df = df.reindex(pd.Index(nodes, name='nodes'), level='nodes')
 
     df = df.rename(columns=lambda x: x.replace('keystone_v3.', ''))
 
     # Plot with stacked bars
-    df.plot.bar(stacked=True, legend=True)
+    ax = df.plot.bar(stacked=True, legend=True)
     plt.tight_layout()
+    return ax.figure
 
-    plt.show()
+
+def _series_figure(store, latency, metric, db=None):
+    """One line of `metric` over time per scenario and nodes"""
+    df = store.query('throughput', latency=latency, db=db)
+    if df is None:
+        logging.error("No throughput with a latency of %sms" % latency)
+        return None
+    fig, ax = plt.subplots()
+    lines = df.reset_index()
+    for (scenario, nodes), line in lines.groupby(['scenario', 'nodes']):
+        ax.plot(line['elapsed'], line[metric],
+                label="%s (%s nodes)" % (scenario, nodes))
+    ax.set_xlabel('elapsed (s)')
+    ax.set_ylabel(metric)
+    ax.legend()
+    fig.tight_layout()
+    return fig
 
 
 def _check_result_dir(directory, folder):
-    pattern = re.compile(("(maria|cockroach)(db)-\d{1,3}"
+    pattern = re.compile(("(mariadb|galera|cockroachdb)-\d{1,3}"
                           "-\d{1,3}"))
     if pattern.match(directory):
         if "backup" in os.listdir(folder + directory):
@@ -219,8 +1814,8 @@ def _check_result_dir(directory, folder):
 
 
 def _find_tar(directory):
-    folder_pattern = re.compile(".*(maria|cockroach).*")
-    tar_pattern = re.compile("(rally-).*(grid5000.fr.tar.gz)")
+    folder_pattern = re.compile(".*(maria|galera|cockroach).*")
+    tar_pattern = re.compile("(rally-).*grid5000.fr" + TAR_EXT)
     tar_in_dir = []
     for folder in os.listdir(directory):
         if folder == "backup":
@@ -231,11 +1826,35 @@ def _find_tar(directory):
                     for tar in os.listdir(path_to_f):
                         path_to_tar = os.path.join(path_to_f, tar)
                         if (tar_pattern.match(tar) and
-                            tarfile.is_tarfile(path_to_tar)):
+                            _is_tar(path_to_tar)):
                             tar_in_dir.append(path_to_tar)
                             return(path_to_tar)
 
 
+@contextmanager
+def _open_tar(tar):
+    """Opens `tar` for a sequential read of its members"""
+    command = TAR_DECOMPRESSORS.get(os.path.splitext(tar)[1])
+    if command is None:
+        with tarfile.open(tar, mode='r|*') as ar:
+            yield ar
+        return
+    proc = subprocess.Popen(command + [tar], stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as ar:
+            yield ar
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def _is_tar(tar):
+    if os.path.splitext(tar)[1] in TAR_DECOMPRESSORS:
+        # Not worth a decompression, trust the extension
+        return os.path.isfile(tar)
+    return tarfile.is_tarfile(tar)
+
+
 # resolved = lambda x: os.path.realpath(os.path.abspath(x))
 def resolved(path):
     return os.path.realpath(os.path.abspath(path))
@@ -253,7 +1872,7 @@ def badlink(info, base):
     return badpath(info.linkname, base=tip)
 
 
-def _safe_json(members, directory):
+def _safe_members(members, directory):
     base = resolved(directory)
 
     for finfo in members:
@@ -266,9 +1885,14 @@ def _safe_json(members, directory):
             logging.error("%s is blocked: Symlink to: %s" % (finfo.name,
                                                              finfo.linkname))
         else:
-            if finfo.name.endswith('.json'):
-                finfo.name = re.sub('rally_home/', '', finfo.name)
-                yield finfo
+            yield finfo
+
+
+def _safe_json(members, directory):
+    for finfo in _safe_members(members, directory):
+        if finfo.name.endswith('.json'):
+            finfo.name = re.sub('rally_home/', '', finfo.name)
+            yield finfo
 
 
 if __name__ == '__main__':
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# CollectD CockroachDB plugin, the counterpart of the mysql plugin for
+# CockroachDB nodes.
+#
+# Reads the metrics of a node from the Prometheus endpoint of its admin UI
+# (http://<node>:8080/_status/vars) and dispatches the ones listed in
+# COCKROACHDB_METRICS, grouped by plugin instance (sql, kv, txn, raft,
+# ranges, node).
+#
+# Configuration:
+#  Import cockroachdb
+#  <Module cockroachdb>
+#  	Host localhost
+#  	Port 8080 (optional)
+#  	Timeout 5 (optional, seconds)
+#   Verbose true (optional, to enable debugging)
+#  </Module>
+#
+# The HTTP connection is kept open between reads, and opened again when the
+# node goes away. Only the lines of the wanted metrics are parsed, the
+# others are skipped on their name.
+#
+# Histograms (latencies are in nanoseconds) are dispatched as the counters
+# <metric>_count and <metric>_sum, and as the gauges <metric>_p50, _p90 and
+# _p99: the quantiles of the observations since the previous read, from
+# their buckets, like histogram_quantile of Prometheus.
+#
+# Metrics with labels (e.g., store="1" of the store metrics) are summed
+# over their labels.
+#
+
+import sys
+
+COLLECTD_ENABLED=True
+try:
+	import collectd
+except ImportError:
+	# We're not running in CollectD, set this to False so we can make some changes
+	# accordingly for testing/development.
+	COLLECTD_ENABLED=False
+import socket
+try:
+	import httplib
+except ImportError:
+	import http.client as httplib
+
+COCKROACHDB_CONFIG = {
+	'Host':    'localhost',
+	'Port':    8080,
+	'Timeout': 5,
+	'Verbose': False,
+}
+
+COCKROACHDB_PATH = '/_status/vars'
+
+# Metrics dispatched, with their plugin instance and type. Names are the
+# Prometheus ones, i.e., the CockroachDB ones with _ instead of .
+COCKROACHDB_METRICS = {
+	# SQL
+	'sql_conns':                        ('sql', 'gauge'),
+	'sql_query_count':                  ('sql', 'counter'),
+	'sql_select_count':                 ('sql', 'counter'),
+	'sql_insert_count':                 ('sql', 'counter'),
+	'sql_update_count':                 ('sql', 'counter'),
+	'sql_delete_count':                 ('sql', 'counter'),
+	'sql_ddl_count':                    ('sql', 'counter'),
+	'sql_misc_count':                   ('sql', 'counter'),
+	'sql_failure_count':                ('sql', 'counter'),
+	'sql_txn_begin_count':              ('sql', 'counter'),
+	'sql_txn_commit_count':             ('sql', 'counter'),
+	'sql_txn_abort_count':              ('sql', 'counter'),
+	'sql_txn_rollback_count':           ('sql', 'counter'),
+	'sql_distsql_queries_total':        ('sql', 'counter'),
+	'sql_exec_latency':                 ('sql', 'histogram'),
+	'sql_service_latency':              ('sql', 'histogram'),
+	'sql_txn_latency':                  ('sql', 'histogram'),
+	'sql_distsql_exec_latency':         ('sql', 'histogram'),
+	'sql_distsql_service_latency':      ('sql', 'histogram'),
+
+	# KV
+	'exec_success':                     ('kv', 'counter'),
+	'exec_error':                       ('kv', 'counter'),
+	'exec_latency':                     ('kv', 'histogram'),
+	'requests_slow_distsender':         ('kv', 'gauge'),
+	'requests_slow_lease':              ('kv', 'gauge'),
+	'requests_slow_raft':               ('kv', 'gauge'),
+	'requests_slow_commandqueue':       ('kv', 'gauge'),
+	'distsender_batches':               ('kv', 'counter'),
+	'distsender_rpc_sent':              ('kv', 'counter'),
+	'distsender_rpc_sent_local':        ('kv', 'counter'),
+	'distsender_errors_notleaseholder': ('kv', 'counter'),
+
+	# Transactions
+	'txn_commits':                      ('txn', 'counter'),
+	'txn_commits1PC':                   ('txn', 'counter'),
+	'txn_aborts':                       ('txn', 'counter'),
+	'txn_abandons':                     ('txn', 'counter'),
+	'txn_durations':                    ('txn', 'histogram'),
+	'txn_restarts':                     ('txn', 'histogram'),
+	'txn_restarts_writetooold':         ('txn', 'counter'),
+	'txn_restarts_serializable':        ('txn', 'counter'),
+	'txn_restarts_possiblereplay':      ('txn', 'counter'),
+	'txn_restarts_deleterange':         ('txn', 'counter'),
+
+	# Raft
+	'raft_rcvd_prop':                   ('raft', 'counter'),
+	'raft_commandsapplied':             ('raft', 'counter'),
+	'raft_heartbeats_pending':          ('raft', 'gauge'),
+	'raft_ticks':                       ('raft', 'counter'),
+	'raft_enqueued_pending':            ('raft', 'gauge'),
+	'raft_process_commandcommit_latency': ('raft', 'histogram'),
+	'raft_process_logcommit_latency':   ('raft', 'histogram'),
+	'leases_success':                   ('raft', 'counter'),
+	'leases_error':                     ('raft', 'counter'),
+
+	# Ranges and replicas
+	'ranges':                           ('ranges', 'gauge'),
+	'ranges_unavailable':               ('ranges', 'gauge'),
+	'ranges_underreplicated':           ('ranges', 'gauge'),
+	'range_splits':                     ('ranges', 'counter'),
+	'range_adds':                       ('ranges', 'counter'),
+	'range_removes':                    ('ranges', 'counter'),
+	'replicas':                         ('ranges', 'gauge'),
+	'replicas_leaders':                 ('ranges', 'gauge'),
+	'replicas_leaseholders':            ('ranges', 'gauge'),
+	'replicas_quiescent':               ('ranges', 'gauge'),
+
+	# Node
+	'liveness_livenodes':               ('node', 'gauge'),
+	'capacity':                         ('node', 'gauge'),
+	'capacity_available':               ('node', 'gauge'),
+	'capacity_used':                    ('node', 'gauge'),
+	'sys_cpu_user_percent':             ('node', 'gauge'),
+	'sys_cpu_sys_percent':              ('node', 'gauge'),
+	'sys_rss':                          ('node', 'gauge'),
+	'sys_goroutines':                   ('node', 'gauge'),
+	'sys_gc_pause_percent':             ('node', 'gauge'),
+	'rocksdb_block_cache_hits':         ('node', 'counter'),
+	'rocksdb_block_cache_misses':       ('node', 'counter'),
+}
+
+# Quantiles of the histograms, by suffix
+COCKROACHDB_QUANTILES = [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]
+
+# Prometheus name of every line to parse -> (metric, part of the metric)
+COCKROACHDB_LINES = {}
+for metric in COCKROACHDB_METRICS:
+	if COCKROACHDB_METRICS[metric][1] == 'histogram':
+		for part in ['bucket', 'sum', 'count']:
+			COCKROACHDB_LINES[metric + '_' + part] = (metric, part)
+	else:
+		COCKROACHDB_LINES[metric] = (metric, 'value')
+
+COCKROACHDB_CONN = None
+# Buckets of every histogram at the previous read
+COCKROACHDB_LAST_BUCKETS = {}
+
+def get_cockroachdb_conn():
+	global COCKROACHDB_CONN
+	if COCKROACHDB_CONN is None:
+		COCKROACHDB_CONN = httplib.HTTPConnection(
+			COCKROACHDB_CONFIG['Host'],
+			COCKROACHDB_CONFIG['Port'],
+			timeout=COCKROACHDB_CONFIG['Timeout']
+		)
+	return COCKROACHDB_CONN
+
+def close_cockroachdb_conn():
+	global COCKROACHDB_CONN
+	if COCKROACHDB_CONN is not None:
+		COCKROACHDB_CONN.close()
+	COCKROACHDB_CONN = None
+
+def cockroachdb_read(conn):
+	"""Text of the Prometheus endpoint"""
+	conn.request('GET', COCKROACHDB_PATH)
+	resp = conn.getresponse()
+	body = resp.read()
+	if resp.status != 200:
+		raise httplib.HTTPException('%s returned %s %s' % (COCKROACHDB_PATH, resp.status, resp.reason))
+	return body.decode('utf-8')
+
+def parse_prometheus(text):
+	"""Values of the metrics of COCKROACHDB_LINES in `text`
+
+	Returns a dict of the metrics with a value, and a dict of the metrics
+	with {'sum': .., 'count': .., 'buckets': {le: cumulative count}}.
+	"""
+	values = {}
+	histograms = {}
+	for line in text.split('\n'):
+		# The name ends at the labels or at the value, comments (# HELP,
+		# # TYPE) and empty lines never match a name
+		end = line.find('{')
+		if end == -1:
+			end = value_start = line.find(' ')
+		else:
+			value_start = line.rfind('}') + 1
+		name = line[:end]
+		if name not in COCKROACHDB_LINES:
+			continue
+
+		metric, part = COCKROACHDB_LINES[name]
+		fields = line[value_start:].split()
+		try:
+			value = float(fields[0])
+		except (IndexError, ValueError):
+			continue
+
+		if part == 'value':
+			values[metric] = values.get(metric, 0) + value
+			continue
+		histogram = histograms.setdefault(metric, {'sum': 0, 'count': 0, 'buckets': {}})
+		if part == 'bucket':
+			start = line.find('le="', end) + 4
+			le = float(line[start:line.find('"', start)])
+			histogram['buckets'][le] = histogram['buckets'].get(le, 0) + value
+		else:
+			histogram[part] += value
+	return values, histograms
+
+def histogram_quantiles(buckets, last_buckets):
+	"""Quantiles of the observations between `last_buckets` and `buckets`
+
+	Buckets map their upper bound to their cumulative count. Returns {}
+	when nothing was observed, or when the node restarted meanwhile.
+	"""
+	bounds = sorted(buckets)
+	counts = [buckets[le] - last_buckets.get(le, 0) for le in bounds]
+	if not counts or counts[-1] <= 0 or min(counts) < 0:
+		return {}
+
+	total = counts[-1]
+	quantiles = {}
+	for suffix, q in COCKROACHDB_QUANTILES:
+		rank = q * total
+		i = 0
+		while counts[i] < rank:
+			i += 1
+		if bounds[i] == float('inf'):
+			# Beyond the largest bucket, its bound is the best guess
+			quantiles[suffix] = bounds[i - 1] if i > 0 else 0
+			continue
+		lower = bounds[i - 1] if i > 0 else 0
+		below = counts[i - 1] if i > 0 else 0
+		inside = counts[i] - below
+		quantiles[suffix] = lower + (bounds[i] - lower) * (rank - below) / inside if inside else bounds[i]
+	return quantiles
+
+def log_verbose(msg):
+	if not COCKROACHDB_CONFIG['Verbose']:
+		return
+	if COLLECTD_ENABLED:
+		collectd.info('cockroachdb plugin: %s' % msg)
+	else:
+		print('cockroachdb plugin: %s' % msg)
+
+def dispatch_value(prefix, key, value, type, type_instance=None):
+	if not type_instance:
+		type_instance = key
+
+	log_verbose('Sending value: %s/%s=%s' % (prefix, type_instance, value))
+	if value is None:
+		return
+	# collectd counters only take integers
+	if type == 'counter':
+		value = int(value)
+
+	if COLLECTD_ENABLED:
+		val               = collectd.Values(plugin='cockroachdb', plugin_instance=prefix)
+		val.type          = type
+		val.type_instance = type_instance
+		val.values        = [value]
+		val.dispatch()
+
+def configure_callback(conf):
+	global COCKROACHDB_CONFIG
+	for node in conf.children:
+		if node.key in COCKROACHDB_CONFIG:
+			COCKROACHDB_CONFIG[node.key] = node.values[0]
+
+	COCKROACHDB_CONFIG['Port']    = int(COCKROACHDB_CONFIG['Port'])
+	COCKROACHDB_CONFIG['Timeout'] = float(COCKROACHDB_CONFIG['Timeout'])
+	COCKROACHDB_CONFIG['Verbose'] = bool(COCKROACHDB_CONFIG['Verbose'])
+
+def read_callback():
+	global COCKROACHDB_LAST_BUCKETS
+	try:
+		text = cockroachdb_read(get_cockroachdb_conn())
+	except (httplib.HTTPException, socket.error) as e:
+		# the node went away or restarted since the last read
+		log_verbose('Reconnecting after %s' % e)
+		close_cockroachdb_conn()
+		text = cockroachdb_read(get_cockroachdb_conn())
+
+	values, histograms = parse_prometheus(text)
+
+	for metric in values:
+		prefix, type = COCKROACHDB_METRICS[metric]
+		dispatch_value(prefix, metric, values[metric], type)
+
+	for metric in histograms:
+		prefix = COCKROACHDB_METRICS[metric][0]
+		histogram = histograms[metric]
+		dispatch_value(prefix, metric + '_count', histogram['count'], 'counter')
+		dispatch_value(prefix, metric + '_sum', histogram['sum'], 'counter')
+		if metric in COCKROACHDB_LAST_BUCKETS:
+			quantiles = histogram_quantiles(histogram['buckets'], COCKROACHDB_LAST_BUCKETS[metric])
+			for suffix in quantiles:
+				dispatch_value(prefix, '%s_%s' % (metric, suffix), quantiles[suffix], 'gauge')
+		COCKROACHDB_LAST_BUCKETS[metric] = histogram['buckets']
+
+if COLLECTD_ENABLED:
+	 collectd.register_read(read_callback)
+	 collectd.register_config(configure_callback)
+
+if __name__ == "__main__" and not COLLECTD_ENABLED:
+	print("Running in test mode, invoke with")
+	print(sys.argv[0] + " Host [Port]")
+	COCKROACHDB_CONFIG['Host'] = sys.argv[1]
+	if len(sys.argv) > 2:
+		COCKROACHDB_CONFIG['Port'] = int(sys.argv[2])
+	COCKROACHDB_CONFIG['Verbose'] = True
+	from pprint import pprint as pp
+	pp(COCKROACHDB_CONFIG)
+	read_callback()
+
+
+# vim:noexpandtab ts=8 sw=8 sts=8
@@ -16,8 +16,20 @@
 #  	Password xxxx
 #  	HeartbeatTable percona.heartbeat (optional, if using pt-heartbeat)
 #   Verbose true (optional, to enable debugging)
+#   Batch true (optional, to read all the sources in a single round trip)
+#   Interval "innodb" 30 (optional, seconds between two reads of a source)
 #  </Module>
 #
+# The connection is kept open between reads, and opened again when the
+# server goes away. In batch mode (the default), the queries of all the
+# sources due at a read go to the server as a single multi statement.
+# When a batch fails, its sources are read alone, and the ones that are
+# not supported (e.g., SHOW BINARY LOGS without binary log) are not read
+# anymore until the next connection.
+#
+# The wsrep_* status of Galera nodes goes to the wsrep plugin instance,
+# with text states (e.g., wsrep_cluster_status) mapped to numbers.
+#
 # Requires "MySQLdb" for Python
 #
 # Author: Chris Boulton <chris@chrisboulton.com>
@@ -34,7 +46,9 @@ except ImportError:
 	# accordingly for testing/development.
 	COLLECTD_ENABLED=False
 import re
+import time
 import MySQLdb
+from MySQLdb.constants import CLIENT, CR
 
 MYSQL_CONFIG = {
 	'Host':           'localhost',
@@ -43,8 +57,48 @@ MYSQL_CONFIG = {
 	'Password':       '',
 	'HeartbeatTable': '',
 	'Verbose':        False,
+	'Batch':          True,
+}
+
+# Sources of the metrics, in the order they are read
+MYSQL_SOURCES = [
+	'status',
+	'variables',
+	'master',
+	'state',
+	'slave',
+	'response_time',
+	'innodb',
+]
+
+# Seconds between two reads of each source, 0 to read it at every
+# interval of collectd
+MYSQL_INTERVALS = {
+	'status':        0,
+	'variables':     60,
+	'master':        60,
+	'state':         0,
+	'slave':         0,
+	'response_time': 0,
+	'innodb':        0,
 }
 
+# Persistent connection, see get_mysql_conn
+MYSQL_CONN = None
+# Time of the last read of each source
+MYSQL_LAST_READ = {}
+# Sources whose query is not supported by this server, until the next
+# connection
+MYSQL_UNAVAILABLE = set()
+# Errors of a connection that needs to be opened again, other errors come
+# from the queries
+MYSQL_CONNECTION_ERRORS = (CR.SERVER_GONE_ERROR, CR.SERVER_LOST)
+# Errors of a query that fails whatever the state of the server: access
+# denied, syntax error, unknown table, unknown variable and no binary log.
+# Other errors (e.g., 1047 on a non primary Galera node, lock wait
+# timeouts) only skip the source for the current read.
+MYSQL_UNSUPPORTED_ERRORS = (1044, 1064, 1109, 1142, 1146, 1193, 1227, 1381)
+
 MYSQL_STATUS_VARS = {
 	'Aborted_clients': 'counter',
 	'Aborted_connects': 'counter',
@@ -159,13 +213,19 @@ MYSQL_STATUS_VARS = {
 	'Threads_created': 'counter',
 	'Threads_running': 'gauge',
 	'Uptime': 'gauge',
+}
+
+# Galera replication status, dispatched under the wsrep instance rather
+# than the status one
+MYSQL_WSREP_VARS = {
 	'wsrep_apply_oooe': 'gauge',
 	'wsrep_apply_oool': 'gauge',
 	'wsrep_apply_window': 'gauge',
-	'wsrep_causal_reads': 'gauge',
+	'wsrep_causal_reads': 'counter',
 	'wsrep_cert_deps_distance': 'gauge',
 	'wsrep_cert_index_size': 'gauge',
 	'wsrep_cert_interval': 'gauge',
+	'wsrep_cluster_conf_id': 'gauge',
 	'wsrep_cluster_size': 'gauge',
 	'wsrep_commit_oooe': 'gauge',
 	'wsrep_commit_oool': 'gauge',
@@ -174,18 +234,21 @@ MYSQL_STATUS_VARS = {
 	'wsrep_flow_control_paused_ns': 'counter',
 	'wsrep_flow_control_recv': 'counter',
 	'wsrep_flow_control_sent': 'counter',
+	'wsrep_last_committed': 'counter',
 	'wsrep_local_bf_aborts': 'counter',
 	'wsrep_local_cert_failures': 'counter',
 	'wsrep_local_commits': 'counter',
+	'wsrep_local_index': 'gauge',
 	'wsrep_local_recv_queue': 'gauge',
 	'wsrep_local_recv_queue_avg': 'gauge',
 	'wsrep_local_recv_queue_max': 'gauge',
 	'wsrep_local_recv_queue_min': 'gauge',
-	'wsrep_local_replays': 'gauge',
+	'wsrep_local_replays': 'counter',
 	'wsrep_local_send_queue': 'gauge',
 	'wsrep_local_send_queue_avg': 'gauge',
 	'wsrep_local_send_queue_max': 'gauge',
 	'wsrep_local_send_queue_min': 'gauge',
+	'wsrep_local_state': 'gauge',
 	'wsrep_received': 'counter',
 	'wsrep_received_bytes': 'counter',
 	'wsrep_repl_data_bytes': 'counter',
@@ -196,6 +259,17 @@ MYSQL_STATUS_VARS = {
 	'wsrep_replicated_bytes': 'counter',
 }
 
+# wsrep status with text values, mapped to gauges
+MYSQL_WSREP_STATES = {
+	'wsrep_cluster_status': {'Primary': 1, 'Non-Primary': 0, 'Disconnected': -1},
+	'wsrep_connected':      {'ON': 1, 'OFF': 0},
+	'wsrep_ready':          {'ON': 1, 'OFF': 0},
+}
+
+# min/avg/max/stddev/samples of the replication latency (seconds), each
+# dispatched as a gauge
+MYSQL_WSREP_LATENCY = ['min', 'avg', 'max', 'stddev', 'samples']
+
 MYSQL_VARS = [
 	'binlog_stmt_cache_size',
 	'innodb_additional_mem_pool_size',
@@ -330,23 +404,105 @@ MYSQL_INNODB_STATUS_MATCHES = {
 	},
 }
 
+MYSQL_QUERIES = {
+	'status':        'SHOW GLOBAL STATUS',
+	'variables':     'SHOW GLOBAL VARIABLES WHERE Variable_name IN (%s)'
+		% ', '.join("'%s'" % var for var in sorted(set(MYSQL_VARS))),
+	'master':        'SHOW BINARY LOGS',
+	# the connection of the plugin is not counted
+	'state':         'SELECT STATE AS State FROM INFORMATION_SCHEMA.PROCESSLIST'
+		' WHERE ID != CONNECTION_ID()',
+	'slave':         'SHOW SLAVE STATUS',
+	'response_time': "SELECT * FROM INFORMATION_SCHEMA.QUERY_RESPONSE_TIME"
+		" WHERE `time` != 'TOO LONG' ORDER BY `time`",
+	'innodb':        'SHOW ENGINE INNODB STATUS',
+}
+
+# Lines of the InnoDB status that fetch_innodb_stats parses
+MYSQL_INNODB_STATUS_TRIGGERS = ['---TRANSACTION', 'lock struct(s)'] + list(MYSQL_INNODB_STATUS_MATCHES)
+MYSQL_INNODB_ROW_SEPARATORS = re.compile(r'[,;] ')
+MYSQL_INNODB_ROW_SPACES = re.compile(r' +')
+
 def get_mysql_conn():
-	return MySQLdb.connect(
-		host=MYSQL_CONFIG['Host'],
-		port=MYSQL_CONFIG['Port'],
-		user=MYSQL_CONFIG['User'],
-		passwd=MYSQL_CONFIG['Password']
-	)
+	global MYSQL_CONN, MYSQL_UNAVAILABLE
+	if MYSQL_CONN is None:
+		# the server may have been upgraded or reconfigured
+		MYSQL_UNAVAILABLE.clear()
+		MYSQL_CONN = MySQLdb.connect(
+			host=MYSQL_CONFIG['Host'],
+			port=MYSQL_CONFIG['Port'],
+			user=MYSQL_CONFIG['User'],
+			passwd=MYSQL_CONFIG['Password'],
+			client_flag=CLIENT.MULTI_STATEMENTS if MYSQL_CONFIG['Batch'] else 0
+		)
+		MYSQL_CONN.autocommit(True)
+	return MYSQL_CONN
+
+def close_mysql_conn():
+	global MYSQL_CONN
+	if MYSQL_CONN is not None:
+		try:
+			MYSQL_CONN.close()
+		except MySQLdb.Error:
+			pass
+	MYSQL_CONN = None
+
+def is_connection_error(e):
+	return isinstance(e, MySQLdb.OperationalError) and e.args[0] in MYSQL_CONNECTION_ERRORS
+
+def probe_mysql_sources(conn, sources):
+	"""Rows of the queries of `sources` read one by one, the sources whose
+	query is not supported are not read anymore"""
+	global MYSQL_UNAVAILABLE
+	rows = {}
+	for source in sources:
+		try:
+			cur = mysql_query(conn, MYSQL_QUERIES[source])
+			rows[source] = cur.fetchall()
+			cur.close()
+		except (MySQLdb.OperationalError, MySQLdb.ProgrammingError) as e:
+			if is_connection_error(e):
+				raise
+			if e.args[0] in MYSQL_UNSUPPORTED_ERRORS:
+				log_verbose('Source %s is unavailable: %s' % (source, e))
+				MYSQL_UNAVAILABLE.add(source)
+			else:
+				log_verbose('Source %s is skipped: %s' % (source, e))
+	return rows
 
 def mysql_query(conn, query):
 	cur = conn.cursor(MySQLdb.cursors.DictCursor)
 	cur.execute(query)
 	return cur
 
-def fetch_mysql_status(conn):
-	result = mysql_query(conn, 'SHOW GLOBAL STATUS')
+def mysql_read(conn, sources):
+	"""Rows of the queries of `sources`, by source"""
+	if not sources:
+		return {}
+	if not MYSQL_CONFIG['Batch']:
+		return probe_mysql_sources(conn, sources)
+
+	cur = conn.cursor(MySQLdb.cursors.DictCursor)
+	try:
+		cur.execute(';\n'.join(MYSQL_QUERIES[source] for source in sources))
+		rows = {}
+		for source in sources:
+			rows[source] = cur.fetchall()
+			cur.nextset()
+	except (MySQLdb.OperationalError, MySQLdb.ProgrammingError) as e:
+		if is_connection_error(e):
+			raise
+		# A failing statement aborts the rest of the batch, the sources
+		# are read alone to find the failing ones
+		log_verbose('Batch failed: %s' % e)
+		cur.close()
+		return probe_mysql_sources(conn, sources)
+	cur.close()
+	return rows
+
+def fetch_mysql_status(rows):
 	status = {}
-	for row in result.fetchall():
+	for row in rows:
 		status[row['Variable_name']] = row['Value']
 
 	# calculate the number of unpurged txns from existing variables
@@ -361,27 +517,40 @@ def fetch_mysql_status(conn):
 
 	return status
 
-def fetch_mysql_master_stats(conn):
-	try:
-		result = mysql_query(conn, 'SHOW BINARY LOGS')
-	except MySQLdb.OperationalError:
-		return {}
+def fetch_wsrep_stats(status):
+	global MYSQL_WSREP_VARS, MYSQL_WSREP_STATES, MYSQL_WSREP_LATENCY
+	stats = {}
+	for key in MYSQL_WSREP_VARS:
+		if key in status and status[key] != '':
+			stats[key] = status[key]
+
+	for key in MYSQL_WSREP_STATES:
+		if key in status:
+			stats[key] = MYSQL_WSREP_STATES[key].get(status[key])
+
+	# 0.000248633/0.000535226/0.00125437/0.000234276/97
+	latency = status.get('wsrep_evs_repl_latency', '').split('/')
+	if len(latency) == len(MYSQL_WSREP_LATENCY):
+		for name, value in zip(MYSQL_WSREP_LATENCY, latency):
+			stats['wsrep_evs_repl_latency_' + name] = value
 
+	return stats
+
+def fetch_mysql_master_stats(rows):
 	stats = {
 		'binary_log_space': 0,
 	}
 
-	for row in result.fetchall():
+	for row in rows:
 		if 'File_size' in row and row['File_size'] > 0:
 			stats['binary_log_space'] += int(row['File_size'])
 
 	return stats
 
-def fetch_mysql_slave_stats(conn):
-	result    = mysql_query(conn, 'SHOW SLAVE STATUS')
-	slave_row = result.fetchone()
-	if slave_row is None:
+def fetch_mysql_slave_stats(rows, conn):
+	if not rows:
 		return {}
+	slave_row = rows[0]
 
 	status = {
 		'relay_log_space': slave_row['Relay_Log_Space'],
@@ -396,6 +565,7 @@ def fetch_mysql_slave_stats(conn):
 		""" % (MYSQL_CONFIG['HeartbeatTable'], slave_row['Master_Server_Id'])
 		result = mysql_query(conn, query)
 		row    = result.fetchone()
+		result.close()
 		if 'delay' in row and row['delay'] != None:
 			status['slave_lag'] = row['delay']
 
@@ -403,11 +573,10 @@ def fetch_mysql_slave_stats(conn):
 	status['slave_stopped'] = 1 if slave_row['Slave_SQL_Running'] != 'Yes' else 0
 	return status
 
-def fetch_mysql_process_states(conn):
+def fetch_mysql_process_states(rows):
 	global MYSQL_PROCESS_STATES
-	result = mysql_query(conn, 'SHOW PROCESSLIST')
 	states = MYSQL_PROCESS_STATES.copy()
-	for row in result.fetchall():
+	for row in rows:
 		state = row['State']
 		if state == '' or state == None: state = 'none'
 		state = re.sub(r'^(Table lock|Waiting for .*lock)$', "Locked", state)
@@ -417,34 +586,23 @@ def fetch_mysql_process_states(conn):
 
 	return states
 
-def fetch_mysql_variables(conn):
+def fetch_mysql_variables(rows):
 	global MYSQL_VARS
-	result = mysql_query(conn, 'SHOW GLOBAL VARIABLES')
 	variables = {}
-	for row in result.fetchall():
+	for row in rows:
 		if row['Variable_name'] in MYSQL_VARS:
 			variables[row['Variable_name']] = row['Value']
 
 	return variables
 
-def fetch_mysql_response_times(conn):
+def fetch_mysql_response_times(rows):
 	response_times = {}
-	try:
-		result = mysql_query(conn, """
-			SELECT *
-			FROM INFORMATION_SCHEMA.QUERY_RESPONSE_TIME
-			WHERE `time` != 'TOO LONG'
-			ORDER BY `time`
-		""")
-	except MySQLdb.OperationalError:
-		return {}
-
 	for i in range(1, 14):
-		row = result.fetchone()
+		row = rows[i - 1] if i <= len(rows) else None
 
 		# fill in missing rows with zeros
 		if not row:
-			row = { 'count': 0, 'total': 0 }
+			row = { 'time': 0, 'count': 0, 'total': 0 }
 
 		row = {key.lower(): val for key, val in row.items()}
 
@@ -456,35 +614,49 @@ def fetch_mysql_response_times(conn):
 
 	return response_times
 
-def fetch_innodb_stats(conn):
-	global MYSQL_INNODB_STATUS_MATCHES, MYSQL_INNODB_STATUS_VARS
-	result = mysql_query(conn, 'SHOW ENGINE INNODB STATUS')
-	row    = result.fetchone()
-	status = row['Status']
+def split_innodb_row(line):
+	return MYSQL_INNODB_ROW_SPACES.split(MYSQL_INNODB_ROW_SEPARATORS.sub(' ', line))
+
+def fetch_innodb_stats(rows):
+	global MYSQL_INNODB_STATUS_MATCHES, MYSQL_INNODB_STATUS_VARS, MYSQL_INNODB_STATUS_TRIGGERS
+	if not rows:
+		return {}
+	status = rows[0]['Status']
 	stats  = dict.fromkeys(MYSQL_INNODB_STATUS_VARS.keys(), 0)
 
-	for line in status.split("\n"):
-		line = line.strip()
-		row  = re.split(r' +', re.sub(r'[,;] ', ' ', line))
-		if line == '': continue
+	# Most lines match nothing, only the lines with a trigger are parsed.
+	# They are found by str.find over the whole status, which is much
+	# faster than searching every line
+	starts = set()
+	for trigger in MYSQL_INNODB_STATUS_TRIGGERS:
+		pos = status.find(trigger)
+		while pos != -1:
+			starts.add(status.rfind("\n", 0, pos) + 1)
+			pos = status.find(trigger, pos + len(trigger))
+
+	for start in sorted(starts):
+		end  = status.find("\n", start)
+		line = status[start:end if end != -1 else len(status)].strip()
 
 		# ---TRANSACTION 124324402462, not started
 		# ---TRANSACTION 124324402468, ACTIVE 0 sec committing
-		if line.find("---TRANSACTION") != -1:
+		if "---TRANSACTION" in line:
 			stats['current_transactions'] += 1
-			if line.find("ACTIVE") != -1:
+			if "ACTIVE" in line:
 				stats['active_transactions'] += 1
 		# LOCK WAIT 228 lock struct(s), heap size 46632, 65 row lock(s), undo log entries 1
 		# 205 lock struct(s), heap size 30248, 37 row lock(s), undo log entries 1
-		elif line.find("lock struct(s)") != -1:
-			if line.find("LOCK WAIT") != -1:
+		elif "lock struct(s)" in line:
+			row = split_innodb_row(line)
+			if "LOCK WAIT" in line:
 				stats['innodb_lock_structs'] += int(row[2])
 				stats['locked_transactions'] += 1
 			else:
 				stats['innodb_lock_structs'] += int(row[0])
 		else:
+			row = split_innodb_row(line)
 			for match in MYSQL_INNODB_STATUS_MATCHES:
-				if line.find(match) == -1: continue
+				if match not in line: continue
 				for key in MYSQL_INNODB_STATUS_MATCHES[match]:
 					value = MYSQL_INNODB_STATUS_MATCHES[match][key]
 					if type(value) is int:
@@ -529,62 +701,99 @@ def configure_callback(conf):
 		if node.key in MYSQL_CONFIG:
 			MYSQL_CONFIG[node.key] = node.values[0]
 
+		elif node.key == 'Interval':
+			source, interval = node.values
+			if source not in MYSQL_INTERVALS:
+				raise ValueError('mysql plugin: unknown source %s' % source)
+			MYSQL_INTERVALS[source] = float(interval)
+
 	MYSQL_CONFIG['Port']    = int(MYSQL_CONFIG['Port'])
 	MYSQL_CONFIG['Verbose'] = bool(MYSQL_CONFIG['Verbose'])
+	MYSQL_CONFIG['Batch']   = bool(MYSQL_CONFIG['Batch'])
 
 def read_callback():
-	global MYSQL_STATUS_VARS
-	conn = get_mysql_conn()
-
-	mysql_status = fetch_mysql_status(conn)
-	for key in mysql_status:
-		if mysql_status[key] == '': mysql_status[key] = 0
-
-		# collect anything beginning with Com_/Handler_ as these change
-		# regularly between  mysql versions and this is easier than a fixed
-		# list
-		if key.split('_', 2)[0] in ['Com', 'Handler']:
-			ds_type = 'counter'
-		elif key in MYSQL_STATUS_VARS:
-			ds_type = MYSQL_STATUS_VARS[key]
-		else:
-			continue
-
-		dispatch_value('status', key, mysql_status[key], ds_type)
-
-	mysql_variables = fetch_mysql_variables(conn)
-	for key in mysql_variables:
-		dispatch_value('variables', key, mysql_variables[key], 'gauge')
-
-	mysql_master_status = fetch_mysql_master_stats(conn)
-	for key in mysql_master_status:
-		dispatch_value('master', key, mysql_master_status[key], 'gauge')
+	global MYSQL_LAST_READ
+	now = time.time()
+	sources = [source for source in MYSQL_SOURCES
+		if source not in MYSQL_UNAVAILABLE
+		and now - MYSQL_LAST_READ.get(source, 0) >= MYSQL_INTERVALS[source]]
 
-	mysql_states = fetch_mysql_process_states(conn)
-	for key in mysql_states:
-		dispatch_value('state', key, mysql_states[key], 'gauge')
-
-	slave_status = fetch_mysql_slave_stats(conn)
-	for key in slave_status:
-		dispatch_value('slave', key, slave_status[key], 'gauge')
-
-	response_times = fetch_mysql_response_times(conn)
-	for key in response_times:
-		dispatch_value('response_time_total', str(key), response_times[key]['total'], 'counter')
-		dispatch_value('response_time_count', str(key), response_times[key]['count'], 'counter')
-
-	innodb_status = fetch_innodb_stats(conn)
-	for key in MYSQL_INNODB_STATUS_VARS:
-		if key not in innodb_status: continue
-		dispatch_value('innodb', key, innodb_status[key], MYSQL_INNODB_STATUS_VARS[key])
+	try:
+		conn = get_mysql_conn()
+		rows = mysql_read(conn, sources)
+	except MySQLdb.OperationalError as e:
+		if not is_connection_error(e):
+			raise
+		# the server went away or restarted since the last read
+		log_verbose('Reconnecting after %s' % e)
+		close_mysql_conn()
+		conn = get_mysql_conn()
+		rows = mysql_read(conn, sources)
+
+	for source in sources:
+		MYSQL_LAST_READ[source] = now
+
+	if 'status' in rows:
+		mysql_status = fetch_mysql_status(rows['status'])
+		for key in mysql_status:
+			if mysql_status[key] == '': mysql_status[key] = 0
+
+			# collect anything beginning with Com_/Handler_ as these change
+			# regularly between  mysql versions and this is easier than a fixed
+			# list
+			if key.split('_', 2)[0] in ['Com', 'Handler']:
+				ds_type = 'counter'
+			elif key in MYSQL_STATUS_VARS:
+				ds_type = MYSQL_STATUS_VARS[key]
+			else:
+				continue
+
+			dispatch_value('status', key, mysql_status[key], ds_type)
+
+		# every node has its own series, under the host of its collectd
+		wsrep_status = fetch_wsrep_stats(mysql_status)
+		for key in wsrep_status:
+			dispatch_value('wsrep', key, wsrep_status[key], MYSQL_WSREP_VARS.get(key, 'gauge'))
+
+	if 'variables' in rows:
+		mysql_variables = fetch_mysql_variables(rows['variables'])
+		for key in mysql_variables:
+			dispatch_value('variables', key, mysql_variables[key], 'gauge')
+
+	if 'master' in rows:
+		mysql_master_status = fetch_mysql_master_stats(rows['master'])
+		for key in mysql_master_status:
+			dispatch_value('master', key, mysql_master_status[key], 'gauge')
+
+	if 'state' in rows:
+		mysql_states = fetch_mysql_process_states(rows['state'])
+		for key in mysql_states:
+			dispatch_value('state', key, mysql_states[key], 'gauge')
+
+	if 'slave' in rows:
+		slave_status = fetch_mysql_slave_stats(rows['slave'], conn)
+		for key in slave_status:
+			dispatch_value('slave', key, slave_status[key], 'gauge')
+
+	if 'response_time' in rows:
+		response_times = fetch_mysql_response_times(rows['response_time'])
+		for key in response_times:
+			dispatch_value('response_time_total', str(key), response_times[key]['total'], 'counter')
+			dispatch_value('response_time_count', str(key), response_times[key]['count'], 'counter')
+
+	if 'innodb' in rows:
+		innodb_status = fetch_innodb_stats(rows['innodb'])
+		for key in MYSQL_INNODB_STATUS_VARS:
+			if key not in innodb_status: continue
+			dispatch_value('innodb', key, innodb_status[key], MYSQL_INNODB_STATUS_VARS[key])
 
 if COLLECTD_ENABLED:
 	 collectd.register_read(read_callback)
 	 collectd.register_config(configure_callback)
 
 if __name__ == "__main__" and not COLLECTD_ENABLED:
-	print "Running in test mode, invoke with"
-	print sys.argv[0] + " Host Port User Password "
+	print("Running in test mode, invoke with")
+	print(sys.argv[0] + " Host Port User Password ")
 	MYSQL_CONFIG['Host'] = sys.argv[1]
 	MYSQL_CONFIG['Port'] = int(sys.argv[2])
 	MYSQL_CONFIG['User'] = sys.argv[3]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""Benchmark the InnoDB status parser of the collectd mysql plugin
+
+Usage:
+    innodb_status [-h | --help] [--transactions=N] [--runs=N] [<dump>...]
+
+Options:
+    -h --help           Show this help
+    --transactions=N    Copies of the transactions of each dump, to get
+                        the size of a loaded server [default: 1000]
+    --runs=N            Number of parses of each dump [default: 20]
+
+Dumps are outputs of SHOW ENGINE INNODB STATUS, innodb-status.txt by
+default. Every dump is parsed by the plugin and by the parser it had
+before, the outputs must be identical and the best time of each is
+reported. The exit status is 1 when the outputs differ.
+
+The plugin imports MySQLdb, like under collectd.
+"""
+
+import os
+import re
+import sys
+import time
+
+from docopt import docopt
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'ansible', 'roles', 'collectd',
+                                'files'))
+import mysql  # noqa: E402
+
+
+def previous_fetch_innodb_stats(status):
+    """fetch_innodb_stats when it parsed every line"""
+    stats = dict.fromkeys(mysql.MYSQL_INNODB_STATUS_VARS.keys(), 0)
+
+    for line in status.split("\n"):
+        line = line.strip()
+        row = re.split(r' +', re.sub(r'[,;] ', ' ', line))
+        if line == '':
+            continue
+
+        if line.find("---TRANSACTION") != -1:
+            stats['current_transactions'] += 1
+            if line.find("ACTIVE") != -1:
+                stats['active_transactions'] += 1
+        elif line.find("lock struct(s)") != -1:
+            if line.find("LOCK WAIT") != -1:
+                stats['innodb_lock_structs'] += int(row[2])
+                stats['locked_transactions'] += 1
+            else:
+                stats['innodb_lock_structs'] += int(row[0])
+        else:
+            for match in mysql.MYSQL_INNODB_STATUS_MATCHES:
+                if line.find(match) == -1:
+                    continue
+                for key in mysql.MYSQL_INNODB_STATUS_MATCHES[match]:
+                    value = mysql.MYSQL_INNODB_STATUS_MATCHES[match][key]
+                    if type(value) is int:
+                        if value < len(row) and row[value].isdigit():
+                            stats[key] = int(row[value])
+                    else:
+                        stats[key] = value(row, stats)
+                break
+
+    return stats
+
+
+def inflate(status, copies):
+    """`status` with `copies` times its list of transactions"""
+    lines = status.split("\n")
+    try:
+        start = lines.index('LIST OF TRANSACTIONS FOR EACH SESSION:') + 1
+        end = lines.index('FILE I/O') - 1
+    except ValueError:
+        return status
+    return "\n".join(lines[:start] + lines[start:end] * copies + lines[end:])
+
+
+def best(fn, arg, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        fn(arg)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    args = docopt(__doc__)
+    copies = int(args['--transactions'])
+    runs = int(args['--runs'])
+    dumps = args['<dump>'] or [os.path.join(HERE, 'innodb-status.txt')]
+
+    differ = False
+    print("%-24s %10s %10s %10s %8s" % ('dump', 'lines', 'previous',
+                                        'plugin', 'speedup'))
+    for dump in dumps:
+        with open(dump) as f:
+            status = inflate(f.read(), copies)
+
+        expected = previous_fetch_innodb_stats(status)
+        actual = mysql.fetch_innodb_stats([{'Status': status}])
+        if actual != expected:
+            differ = True
+            for key in sorted(set(expected) | set(actual)):
+                if expected.get(key) != actual.get(key):
+                    print("%s: %s differs, %r instead of %r"
+                          % (dump, key, actual.get(key), expected.get(key)))
+
+        previous = best(previous_fetch_innodb_stats, status, runs)
+        plugin = best(mysql.fetch_innodb_stats, [{'Status': status}], runs)
+        print("%-24s %10d %9.1fms %9.1fms %7.1fx"
+              % (os.path.basename(dump), status.count("\n"),
+                 previous * 1000, plugin * 1000, previous / plugin))
+
+    if differ:
+        exit("outputs of the parsers differ")
+
+
+if __name__ == '__main__':
+    main()
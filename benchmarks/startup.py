@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""Measure the startup time of the juice and analysis CLIs
+
+Usage:
+    startup [-h | --help] [--runs=N] [--max=SECONDS]
+
+Options:
+    -h --help       Show this help
+    --runs=N        Number of runs of each command [default: 5]
+    --max=SECONDS   Fail when the median wall time of a command is above
+                    SECONDS [default: 1.0]
+
+Every command is run in a fresh interpreter, from the root of the
+repository, and is expected to exit before doing any real work. `juice
+info` reads an empty environment directory made for the benchmark. The
+median is reported along with the min and max, and the exit status is 1
+when one of the commands fails or is slower than --max.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# {env} is the environment directory of the benchmark
+COMMANDS = [['juice.py', 'help'],
+            ['juice.py', 'info', '--env={env}'],
+            ['analysis.py', '--help']]
+
+
+def measure(command, runs):
+    """Wall times in seconds of `runs` runs of `command`
+
+    Returns None if one of the runs fails, e.g., `juice info` without
+    enoslib, whose timing would not include the import of enoslib.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        returncode = subprocess.call([sys.executable] + command, cwd=ROOT,
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+        if returncode != 0:
+            return None
+    return sorted(times)
+
+
+def main():
+    args = docopt(__doc__)
+    runs = int(args['--runs'])
+    limit = float(args['--max'])
+
+    slow, failed = [], []
+    print("%-24s %8s %8s %8s" % ('command', 'min', 'median', 'max'))
+    with tempfile.TemporaryDirectory() as env:
+        for command in COMMANDS:
+            command = [arg.format(env=env) for arg in command]
+            name = ' '.join(command[:2])
+            times = measure(command, runs)
+            if times is None:
+                print("%-24s %8s" % (name, 'failed'))
+                failed.append(name)
+                continue
+            median = times[len(times) // 2]
+            print("%-24s %8.3f %8.3f %8.3f" % (name, times[0], median,
+                                               times[-1]))
+            if median > limit:
+                slow.append(name)
+
+    if failed:
+        exit("failed: %s" % ', '.join(failed))
+    if slow:
+        exit("slower than %.3fs: %s" % (limit, ', '.join(slow)))
+
+
+if __name__ == '__main__':
+    main()
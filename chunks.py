@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+"""Content addressed incremental backups
+
+Directories of the nodes (e.g., /influxdb-data) are split in chunks of
+CHUNK_SIZE bytes, named by their sha256. The control host keeps the
+chunks in a store shared by all the combinations of an experiment, and
+only pulls the chunks it does not have yet. Each backup then writes a
+manifest that lists the chunks of every file, and the directories so
+that empty ones are kept, from which `restore` rebuilds the usual
+archives of the backup.
+
+This file is also the script that runs on the nodes, with their python3
+(3.5 on debian9):
+
+    chunks.py manifest DIRECTORY  prints the manifest of DIRECTORY
+    chunks.py send DIRECTORY      writes the chunks whose names are read
+                                  on stdin, one per line, to stdout
+
+The nodes keep the chunks of each file in a cache along with its size
+and mtime, so that unchanged files are not hashed again.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tarfile
+import threading
+
+
+CHUNK_SIZE = 4 * 1024 * 1024
+MANIFEST_VERSION = 2
+# Where the script and its cache live on the nodes
+NODE_SCRIPT = '/tmp/juice-chunks.py'
+NODE_CACHE = '/tmp/juice-chunks'
+
+
+class ChunkChanged(Exception):
+    """A chunk pulled from a node does not match its name anymore"""
+
+
+######################################################################
+# Nodes
+######################################################################
+
+
+def manifest(directory):
+    """Files of `directory` with their chunks, with the help of the cache
+
+    Directories come before their content, as entries without chunks.
+    """
+    cache_path = _cache_path(directory)
+    try:
+        with open(cache_path) as f:
+            cache = {e['path']: e for e in json.load(f)['files']}
+    except (IOError, ValueError):
+        cache = {}
+
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        stat = os.stat(root)
+        files.append({'path': os.path.relpath(root, directory), 'size': 0,
+                      'mtime': stat.st_mtime,
+                      'mode': stat.st_mode & 0o7777,
+                      'chunks': [], 'directory': True})
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            rel = os.path.relpath(path, directory)
+            cached = cache.get(rel)
+            if (cached is not None and cached['size'] == stat.st_size and
+                    cached['mtime'] == stat.st_mtime):
+                files.append(cached)
+                continue
+            files.append({'path': rel, 'size': stat.st_size,
+                          'mtime': stat.st_mtime,
+                          'mode': stat.st_mode & 0o7777,
+                          'chunks': list(_hash_chunks(path))})
+
+    if not os.path.isdir(NODE_CACHE):
+        os.makedirs(NODE_CACHE)
+    with open(cache_path, 'w') as f:
+        json.dump({'directory': directory, 'files': files}, f)
+    return files
+
+
+def send(directory, names, out):
+    """Writes the chunks `names` of `directory` to `out`, in that order
+
+    Chunks are looked up in the cache written by the last `manifest`.
+    """
+    with open(_cache_path(directory)) as f:
+        files = json.load(f)['files']
+    where = {}
+    for entry in files:
+        for i, name in enumerate(entry['chunks']):
+            where.setdefault(name, (entry['path'], i * CHUNK_SIZE))
+    for name in names:
+        path, offset = where[name]
+        with open(os.path.join(directory, path), 'rb') as f:
+            f.seek(offset)
+            out.write(f.read(CHUNK_SIZE))
+    out.flush()
+
+
+def _hash_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield hashlib.sha256(chunk).hexdigest()
+
+
+def _cache_path(directory):
+    key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()
+    return os.path.join(NODE_CACHE, key + '.json')
+
+
+######################################################################
+# Control host
+######################################################################
+
+
+def backup(sources, store, workers=8):
+    """Pulls the missing chunks of `sources` into `store`
+
+    `sources` are dicts with the `host` to read, the `name`, `path` and
+    `archive` of its directory, and the `container` to stop while the
+    directory is read, if any. Hosts are pulled concurrently, by at most
+    `workers` at a time. Sources whose host cannot be read, or with a file
+    that changed during the backup, are logged and left out of the
+    manifest.
+
+    Returns the manifest of the backup.
+    """
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        backups = list(executor.map(lambda s: _backup(s, store), sources))
+    return {'version': MANIFEST_VERSION, 'chunk_size': CHUNK_SIZE,
+            'sources': [b for b in backups if b and b['files']]}
+
+
+def write_manifest(manifest, path, store):
+    """Writes `manifest` to `path`, with the store relative to it"""
+    manifest = dict(manifest, store=os.path.relpath(
+        os.path.abspath(store), os.path.dirname(os.path.abspath(path))))
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def restore(manifest_path, store=None, backup_dir=None):
+    """Rebuilds the gzip archives of the backup of `manifest_path`
+
+    The store and the backup directory default to the ones of the
+    manifest. Returns the paths of the archives.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise Exception('{!r} has the unsupported version {!r}'.format(
+            manifest_path, manifest.get('version')))
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    store = store or os.path.join(base, manifest['store'])
+    backup_dir = backup_dir or base
+
+    archives = []
+    for source in manifest['sources']:
+        archive = os.path.join(backup_dir, source['archive'])
+        root = os.path.basename(source['path'].rstrip('/'))
+        with tarfile.open(archive, 'w:gz') as ar:
+            for entry in source['files']:
+                info = tarfile.TarInfo(
+                    os.path.normpath(os.path.join(root, entry['path'])))
+                info.size = entry['size']
+                info.mode = entry['mode']
+                info.mtime = entry['mtime']
+                if entry.get('directory'):
+                    info.type = tarfile.DIRTYPE
+                    ar.addfile(info)
+                else:
+                    ar.addfile(info, _ChunkReader(store, entry['chunks']))
+        logging.info('%s restored from %d entries'
+                     % (archive, len(source['files'])))
+        archives.append(archive)
+    return archives
+
+
+def _backup(source, store):
+    from utils import ssh_options
+
+    host = source['host']
+    ssh = ['ssh'] + ssh_options(host) + [host.address]
+    try:
+        subprocess.check_call(['scp', '-q'] + ssh_options(host) +
+                              [os.path.abspath(__file__),
+                               '%s:%s' % (host.address, NODE_SCRIPT)])
+        if source.get('container'):
+            subprocess.call(ssh + ['docker', 'stop', source['container']],
+                            stdout=subprocess.DEVNULL)
+        try:
+            out = subprocess.check_output(
+                ssh + ['python3', NODE_SCRIPT, 'manifest', source['path']])
+            files = json.loads(out.decode())
+            sizes = {}
+            for entry in files:
+                for i, name in enumerate(entry['chunks']):
+                    sizes[name] = min(CHUNK_SIZE,
+                                      entry['size'] - i * CHUNK_SIZE)
+            missing = sorted(name for name in sizes
+                             if not os.path.exists(_chunk_path(store, name)))
+            if missing:
+                _receive(ssh + ['python3', NODE_SCRIPT, 'send',
+                                source['path']],
+                         missing, sizes, store)
+        finally:
+            if source.get('container'):
+                subprocess.call(ssh + ['docker', 'start',
+                                       source['container']],
+                                stdout=subprocess.DEVNULL)
+    except (subprocess.CalledProcessError, ChunkChanged) as e:
+        # One unreachable host, or one file written during the backup,
+        # does not fail the backup of the others
+        logging.error('%s:%s is not backed up: %s'
+                      % (host.alias, source['path'], e))
+        return None
+
+    size = sum(entry['size'] for entry in files)
+    pulled = sum(sizes[name] for name in missing)
+    logging.info('%s:%s has %d bytes, %d pulled'
+                 % (host.alias, source['path'], size, pulled))
+    return {'host': host.alias, 'name': source['name'],
+            'path': source['path'], 'archive': source['archive'],
+            'files': files}
+
+
+def _receive(command, names, sizes, store):
+    """Stores the chunks `names` that `command` writes to its stdout"""
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    # The list is small enough to be written before reading the chunks
+    proc.stdin.write(('\n'.join(names) + '\n').encode())
+    proc.stdin.close()
+    try:
+        for name in names:
+            chunk = proc.stdout.read(sizes[name])
+            if hashlib.sha256(chunk).hexdigest() != name:
+                raise ChunkChanged(
+                    'Chunk {} changed during the backup'.format(name))
+            path = _chunk_path(store, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Hosts with the same chunk may pull it at the same time
+            part = '%s.%d.part' % (path, threading.get_ident())
+            with open(part, 'wb') as f:
+                f.write(chunk)
+            os.rename(part, path)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+def _chunk_path(store, name):
+    return os.path.join(store, name[:2], name)
+
+
+class _ChunkReader(object):
+    """File-like object that reads a file from its chunks in the store"""
+
+    def __init__(self, store, names):
+        self._paths = [_chunk_path(store, name) for name in names]
+        self._file = None
+
+    def read(self, size=-1):
+        data = b''
+        while self._paths and (size < 0 or len(data) < size):
+            if self._file is None:
+                self._file = open(self._paths[0], 'rb')
+            part = self._file.read(-1 if size < 0 else size - len(data))
+            if not part:
+                self._file.close()
+                self._file = None
+                self._paths.pop(0)
+            data += part
+        return data
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ['manifest', 'send']:
+        exit('usage: chunks.py (manifest | send) DIRECTORY')
+    command, directory = sys.argv[1:]
+    if command == 'manifest':
+        files = manifest(directory) if os.path.isdir(directory) else []
+        json.dump(files, sys.stdout)
+    else:
+        send(directory, sys.stdin.read().split(),
+             getattr(sys.stdout, 'buffer', sys.stdout))
@@ -1,12 +1,11 @@
 #!/usr/bin/env python
 
-import copy
 import logging
 import os
-from pprint import pformat
 
 import juice as j
 from execo_engine.sweep import (ParamSweeper, sweep)
+from sweep import PipelinedSweep
 
 SWEEPER_DIR = os.path.join(os.getenv('HOME'), 'juice-sweeper')
 
@@ -107,18 +106,14 @@ def init():
         "experiment: %s" % e)
 
 
-def teardown():
-  try:
-    j.destroy()
-    j.emulate(CONF['tc'])
-  except Exception as e:
-    logging.warning(
-        "Setup went wrong. This is not necessarily a bad news, "
-        "in particular, if it is the first time you run the "
-        "experiment: %s" % e)
+def setup(conf, combination):
+    conf['g5k']['resources']['machines'][0]['nodes'] = combination['db-nodes']
+    conf['database'] = combination['db']
 
 
 def keystone_exp():
+    # Combinations are ordered to redeploy as little as possible, see
+    # sweep.PipelinedSweep
     sweeper = ParamSweeper(
         SWEEPER_DIR,
         sweeps=sweep({
@@ -126,39 +121,13 @@ def keystone_exp():
             , 'delay': DELAYS
             , 'db-nodes': CLUSTER_SIZES
         }))
+    PipelinedSweep(
+        sweeper, CONF,
+        run=lambda c: j.rally(SCENARIOS, "keystone", False),
+        xp_name=lambda c: "%s-%s-%s" % (c['db'], c['db-nodes'], c['delay']),
+        setup=setup,
+    ).start()
 
-    while sweeper.get_remaining():
-        combination = sweeper.get_next()
-        logging.info("Treating combination %s" % pformat(combination))
-
-        try:
-            # Setup parameters
-            conf = copy.deepcopy(CONF)  # Make a deepcopy so we can run
-                                        # multiple sweeps in parallels
-            conf['g5k']['resources']['machines'][0]['nodes'] = combination['db-nodes']
-            conf['tc']['constraints'][0]['delay'] = "%sms" % combination['delay']
-            db = combination['db']
-            xp_name = "%s-%s-%s" % (db, combination['db-nodes'], combination['delay'])
-
-            # Let's get it started hun!
-            j.deploy(conf, db, xp_name)
-            j.openstack(db)
-            j.emulate(conf['tc'])
-            j.rally(SCENARIOS, "keystone", burst=False)
-            j.backup()
-
-            # Everything works well, mark combination as done
-            sweeper.done(combination)
-            logging.info("End of combination %s" % pformat(combination))
-
-        except Exception as e:
-          # Oh no, something goes wrong! Mark combination as cancel for
-          # a later retry
-            logging.error("Combination %s Failed with message %s" % (pformat(combination), e))
-            sweeper.cancel(combination)
-
-        finally:
-            teardown()
 
 if __name__ == '__main__':
     # Do the initial reservation and boilerplate
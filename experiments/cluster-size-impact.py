@@ -3,13 +3,12 @@
 import sys
 sys.path.insert(0, '..')  # Give me an access to juice
 
-import copy
 import logging
 import os
-from pprint import pformat
 
 import juice as j
 from execo_engine.sweep import (ParamSweeper, sweep)
+from sweep import PipelinedSweep
 
 
 SWEEPER_DIR = os.path.join(os.getenv('HOME'), 'juice-sweeper-cluster-impact')
@@ -105,17 +104,14 @@ def init():
         "experiment: %s" % e)
 
 
-def teardown():
-  try:
-    j.destroy()
-  except Exception as e:
-    logging.warning(
-        "Setup went wrong. This is not necessarily a bad news, "
-        "in particular, if it is the first time you run the "
-        "experiment: %s" % e)
+def setup(conf, combination):
+    conf['g5k']['resources']['machines'][0]['nodes'] = combination['db-nodes']
+    conf['database'] = combination['db']
 
 
 def keystone_exp():
+    # Combinations are ordered to redeploy as little as possible, see
+    # sweep.PipelinedSweep
     sweeper = ParamSweeper(
         SWEEPER_DIR,
         sweeps=sweep({
@@ -123,40 +119,15 @@ def keystone_exp():
             , 'db-nodes': CLUSTER_SIZES
             , 'burst':    BURST
         }))
+    PipelinedSweep(
+        sweeper, CONF,
+        run=lambda c: j.rally(SCENARIOS, "keystone", c['burst']),
+        xp_name=lambda c: "%s-%s-0-%s" % (c['db'], c['db-nodes'],
+                                          str(c['burst'])[0]),
+        setup=setup,
+        delay=None,
+    ).start()
 
-    while sweeper.get_remaining():
-        combination = sweeper.get_next()
-        logging.info("Treating combination %s" % pformat(combination))
-
-        db    = combination['db']
-        csize = combination['db-nodes']
-        burst = combination['burst']
-
-        try:
-            # Setup parameters
-            conf = copy.deepcopy(CONF)  # Make a deepcopy so we can run
-                                        # multiple sweeps in parallels
-            conf['g5k']['resources']['machines'][0]['nodes'] = csize
-            xp_name = "%s-%s-0-%s" % (db, csize, str(burst)[0])
-
-            # Let's get it started hun!
-            j.deploy(conf, db, xp_name)
-            j.openstack(db)
-            j.rally(SCENARIOS, "keystone", burst)
-            j.backup()
-
-            # Everything works well, mark combination as done
-            sweeper.done(combination)
-            logging.info("End of combination %s" % pformat(combination))
-
-        except Exception as e:
-          # Oh no, something goes wrong! Mark combination as cancel for
-          # a later retry
-            logging.error("Combination %s Failed with message %s" % (pformat(combination), e))
-            sweeper.cancel(combination)
-
-        finally:
-            teardown()
 
 if __name__ == '__main__':
     # Do the initial reservation and boilerplate
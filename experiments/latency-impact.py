@@ -3,13 +3,12 @@
 import sys
 sys.path.insert(0, '..')  # Give me an access to juice
 
-import copy
 import logging
 import os
-from pprint import pformat
 
 import juice as j
 from execo_engine.sweep import (ParamSweeper, sweep)
+from sweep import PipelinedSweep
 
 
 SWEEPER_DIR = os.path.join(os.getenv('HOME'), 'juice-sweeper-latency-impact')
@@ -104,58 +103,26 @@ def init():
         "experiment: %s" % e)
 
 
-def teardown():
-  try:
-    j.destroy()
-    j.emulate(CONF['tc'])
-  except Exception as e:
-    logging.warning(
-        "Setup went wrong. This is not necessarily a bad news, "
-        "in particular, if it is the first time you run the "
-        "experiment: %s" % e)
+def setup(conf, combination):
+    conf['database'] = combination['db']
 
 
 def keystone_exp():
+    # Combinations are ordered to redeploy as little as possible, see
+    # sweep.PipelinedSweep
     sweeper = ParamSweeper(
         SWEEPER_DIR,
         sweeps=sweep({'db': DATABASES, 'delay': DELAYS, 'burst': BURST})
     )
+    PipelinedSweep(
+        sweeper, CONF,
+        run=lambda c: j.rally(SCENARIOS, "keystone", c['burst']),
+        xp_name=lambda c: "%s-9-%s-%s" % (c['db'], c['delay'],
+                                          str(c['burst'])[0]),
+        setup=setup,
+        deployment=['db'],
+    ).start()
 
-    while sweeper.get_remaining():
-        combination = sweeper.get_next()
-        logging.info("Treating combination %s" % pformat(combination))
-
-        db    = combination['db']
-        delay = combination['delay']
-        burst = combination['burst']
-
-        try:
-            # Setup parameters
-            conf = copy.deepcopy(CONF)  # Make a deepcopy so we can run
-                                        # multiple sweeps in parallels
-            conf['tc']['constraints'][0]['delay'] = "%sms" % delay
-            xp_name = "%s-9-%s-%s" % (db, delay, str(burst)[0])
-            conf['database'] = db
-
-            # Let's get it started hun!
-            j.deploy(conf=conf, xp_name=xp_name)
-            j.openstack()
-            j.emulate(conf['tc'])
-            j.rally(SCENARIOS, "keystone", burst)
-            j.backup()
-
-            # Everything works well, mark combination as done
-            sweeper.done(combination)
-            logging.info("End of combination %s" % pformat(combination))
-
-        except Exception as e:
-          # Oh no, something goes wrong! Mark combination as cancel for
-          # a later retry
-            logging.error("Combination %s Failed with message %s" % (pformat(combination), e))
-            sweeper.cancel(combination)
-
-        finally:
-            teardown()
 
 if __name__ == '__main__':
     # Do the initial reservation and boilerplate
@@ -11,12 +11,13 @@ Options:
     -v --version   Show version number
 
 Commands:
-    deploy         Claim resources from g5k and configure them
+    deploy         Claim resources from g5k (or fake ones) and configure them
     openstack      Add OpenStack Keystone to the deployment
     rally          Benchmark the Openstack
     stress         Launch sysbench tests (after a deployment)
     emulate        Emulate network using tc
     backup         Backup the environment
+    restore        Rebuild the archives of an incremental backup
     destroy        Destroy all the running dockers (not the resources)
     info           Show information of the actual deployment
     help           Show this help
@@ -31,15 +32,18 @@ import pprint
 import yaml
 import json
 import operator
+import itertools
 import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from docopt import docopt
-from enoslib.api import (generate_inventory, emulate_network,
-                         validate_network)
-from enoslib.task import enostask, _save_env
 
+import chunks
+# enoslib is imported by the commands that need it, see utils.enostask
 from utils import (JUICE_PATH, ANSIBLE_PATH, SYMLINK_NAME, doc,
-                   doc_lookup, run_ansible, g5k_deploy)
+                   doc_lookup, enostask, run_ansible, run_playbook,
+                   record_call, pull, g5k_deploy, local_deploy)
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -75,16 +79,26 @@ usage: juice deploy [--conf CONFIG_PATH] [--provider PROVIDER]
 
 Claim resources from PROVIDER and configure them.
 
+The local provider fabricates the hosts of the `local` section of the
+configuration, or of the g5k resources if there is none, and only
+records the ansible calls of the following commands in the calls.jsonl
+file of the experiment. This measures the orchestration without a
+reservation.
+
 Options:
   --conf CONFIG_PATH    Path to the configuration file describing the
                         deployment [default: ./conf.yaml]
-  --provider PROVIDER   Provider to target [default: g5k]
+  --provider PROVIDER   Provider to target, either g5k or local
+                        [default: g5k]
   --force-deployment    Force provider to redo the deployment
   --xp-name NAME        NAME of the folder generated by juice for this
                         new deployment.
   --tags TAGS           Only run tasks relative to the specific tags
                         [default: provide inventory scaffold]
     """
+    from enoslib.api import generate_inventory
+    from enoslib.task import _save_env
+
     # Read the configuration
     config = {}
 
@@ -111,6 +125,12 @@ Options:
             updated_env = g5k_deploy(config['g5k'], env=xp_name,
                                      force_deploy=force_deployment)
             env.update(updated_env)
+        elif provider == 'local' and ('local' in config or 'g5k' in config):
+            env['provider'] = 'local'
+            local_config = config.get('local', config.get('g5k', {}).get(
+                'resources', {}))
+            updated_env = local_deploy(local_config, env=xp_name)
+            env.update(updated_env)
         else:
             raise Exception(
                 'The provider {!r} is not supported or it lacks a configuration'.format(provider))
@@ -119,7 +139,8 @@ Options:
     if 'inventory' in tags:
         env['inventory'] = os.path.join(env['resultdir'], 'hosts')
         generate_inventory(env['roles'] , env['networks'],
-                           env['inventory'], check_networks=True)
+                           env['inventory'],
+                           check_networks=not env.get('dry_run'))
         _save_env(env)
 
 
@@ -134,13 +155,75 @@ Options:
 
 @doc()
 @enostask()
-def backup(backup_dir='current/backup', env=None, **kwargs):
+def backup(backup_dir='current/backup', parallel=False, compression='gzip',
+           compression_level=None, pull_workers=8, incremental=False,
+           chunk_store='chunks', env=None, **kwargs):
     """
-usage: juice backup [--backup-dir DIRECTORY]
+usage: juice backup [--backup-dir DIRECTORY] [--parallel]
+                    [--compression COMPRESSOR] [--compression-level N]
+                    [--pull-workers N] [--incremental]
+                    [--chunk-store DIRECTORY]
 
 Backup the experiment
-  --backup-dir DIRECTORY  Backup directory [default: current/backup]
+
+In parallel mode, the backups of scaffolding, openstack and rally run at
+the same time, and the archives are pulled from the nodes with scp
+rather than fetched one by one by ansible.
+
+In incremental mode, the influxdb, rally and sysbench data are not
+archived on the nodes. Only their chunks missing from the chunk store
+are pulled, and the backup directory gets a manifest.json from which
+`juice restore` rebuilds the archives.
+
+Options:
+  --backup-dir DIRECTORY     Backup directory [default: current/backup]
+  --parallel                 Run the playbooks concurrently and pull the
+                             archives
+  --compression COMPRESSOR   Compressor of the archives, either gzip,
+                             zstd or lz4 [default: gzip]
+  --compression-level N      Level of the compressor, its own default
+                             otherwise
+  --pull-workers N           Number of hosts pulled at the same time in
+                             parallel or incremental mode [default: 8]
+  --incremental              Pull the data in chunks, skipping the ones
+                             of the previous backups
+  --chunk-store DIRECTORY    Chunks of the incremental backups, shared by
+                             the experiments [default: chunks]
+    """
+    run_backup(env, backup_dir=backup_dir, parallel=parallel,
+               compression=compression,
+               compression_level=compression_level,
+               pull_workers=pull_workers, incremental=incremental,
+               chunk_store=chunk_store)
+
+
+def run_backup(env, backup_dir='current/backup', parallel=False,
+               compression='gzip', compression_level=None, pull_workers=8,
+               incremental=False, chunk_store='chunks'):
+    """`backup` with the given state, which it neither loads nor saves"""
+    archive_backup(env, backup_dir=backup_dir, parallel=parallel,
+                   compression=compression,
+                   compression_level=compression_level,
+                   incremental=incremental)
+    if parallel or incremental:
+        pull_backup(env, backup_dir=backup_dir, compression=compression,
+                    pull_workers=pull_workers, incremental=incremental,
+                    chunk_store=chunk_store)
+
+
+def archive_backup(env, backup_dir='current/backup', parallel=False,
+                   compression='gzip', compression_level=None,
+                   incremental=False):
+    """Runs the backup playbooks with the given state
+
+    The archives are fetched into `backup_dir`, or left on the nodes for
+    `pull_backup` in parallel mode. The sweeps pull them while the next
+    combination runs, see `sweep.PipelinedSweep`.
     """
+    if compression not in ['gzip', 'zstd', 'lz4']:
+        raise Exception(
+            'The compressor {!r} is not supported'.format(compression))
+
     backup_dir = os.path.abspath(backup_dir)
     os.path.isdir(backup_dir) or os.mkdir(backup_dir)
 
@@ -149,11 +232,107 @@ Backup the experiment
         "db": env['db'],
         "backup_dir": backup_dir,
         "monitoring": env['monitoring'],
-        "rally_nodes": env.get('rally_nodes', [])
+        "rally_nodes": env.get('rally_nodes', []),
+        "backup_compression": compression,
+        "backup_pull": parallel,
+        "backup_incremental": incremental
     }
-    run_ansible('scaffolding.yml', extra_vars=extra_vars)
-    run_ansible('openstack.yml', extra_vars=extra_vars)
-    run_ansible('rally.yml', extra_vars=extra_vars)
+    if compression_level is not None:
+        extra_vars["backup_compression_level"] = int(compression_level)
+    playbooks = ['scaffolding.yml', 'openstack.yml', 'rally.yml']
+
+    if parallel:
+        # Ansible is not thread safe, each playbook runs in its own process
+        with ProcessPoolExecutor(max_workers=len(playbooks)) as executor:
+            futures = [executor.submit(run_playbook, env, playbook,
+                                       extra_vars=extra_vars)
+                       for playbook in playbooks]
+            for future in futures:
+                future.result()
+    else:
+        for playbook in playbooks:
+            run_playbook(env, playbook, extra_vars=extra_vars)
+
+
+def pull_backup(env, backup_dir='current/backup', compression='gzip',
+                pull_workers=8, incremental=False, chunk_store='chunks'):
+    """Pulls the archives of `archive_backup` in parallel mode, or the
+    chunks of the data in incremental mode, into `backup_dir`
+
+    It does not run ansible, other playbooks may run meanwhile.
+    """
+    backup_dir = os.path.abspath(backup_dir)
+    if env.get('dry_run'):
+        record_call(env, 'incremental' if incremental else 'pull',
+                    backup_dir=backup_dir)
+        return
+
+    hosts = {host.alias: host for hosts in env['roles'].values()
+                              for host in hosts}
+    if incremental:
+        chunk_store = os.path.abspath(chunk_store)
+        manifest = chunks.backup(_incremental_sources(env), chunk_store,
+                                 workers=int(pull_workers))
+        chunks.write_manifest(manifest,
+                              os.path.join(backup_dir, 'manifest.json'),
+                              chunk_store)
+    else:
+        ext = {'gzip': 'gz', 'zstd': 'zst', 'lz4': 'lz4'}[compression]
+        pull(hosts.values(), '/juice-backup/*.tar.%s' % ext, backup_dir,
+             workers=int(pull_workers))
+
+
+def _incremental_sources(env):
+    """Directories of the incremental backup, see `chunks.backup`
+
+    The archives are named like the ones of the regular backup.
+    """
+    rally_nodes = env.get('rally_nodes', [])
+    if not isinstance(rally_nodes, list):
+        rally_nodes = [rally_nodes]
+
+    def short(host):
+        return host.alias.split('.')[0]
+
+    sources = [{'host': host, 'name': 'influxdb', 'path': '/influxdb-data',
+                'archive': 'influxdb-data.tar.gz', 'container': 'influxdb'}
+               for host in env['roles'].get('control', [])[:1]]
+    sources.extend({'host': host, 'name': 'rally',
+                    'path': '/root/rally_home',
+                    'archive': 'rally-%s.tar.gz' % short(host)}
+                   for host in env['roles'].get('rally', [])
+                   if host.address in rally_nodes)
+    # Like the sysbench play of scaffolding.yml, the clients of a
+    # distributed stress run on the sysbench hosts
+    sysbench_hosts = {}
+    for role in ['database', 'sysbench']:
+        for host in env['roles'].get(role, []):
+            sysbench_hosts.setdefault(host.alias, host)
+    sources.extend({'host': host, 'name': 'sysbench', 'path': '/sysbench',
+                    'archive': 'sysbench-%s.tar.gz' % short(host)}
+                   for host in sysbench_hosts.values())
+    return sources
+
+
+@doc()
+def restore(manifest, chunk_store=None, backup_dir=None, **kwargs):
+    """
+usage: juice restore [--manifest PATH] [--chunk-store DIRECTORY]
+                     [--backup-dir DIRECTORY]
+
+Rebuild the archives of an incremental backup.
+
+Options:
+  --manifest PATH            Manifest of the backup
+                             [default: current/backup/manifest.json]
+  --chunk-store DIRECTORY    Chunks of the backup, the store of the
+                             backup otherwise
+  --backup-dir DIRECTORY     Where to write the archives, next to the
+                             manifest otherwise
+    """
+    for archive in chunks.restore(manifest, store=chunk_store,
+                                  backup_dir=backup_dir):
+        print(archive)
 
 
 @doc()
@@ -206,27 +385,88 @@ Launch OpenStack.
 
 @doc()
 @enostask()
-def stress(env=None, **kwargs):
+def stress(workload=['oltp_read_write'], threads=[1], tables=[1],
+           table_size=[1000000], duration=[10], report_interval=10,
+           reuse_dataset=False, prepare_threads=1, distributed=False,
+           target='local', start_delay=30, env=None, **kwargs):
     """
-usage: juice stress
+usage: juice stress [--workload WORKLOAD...] [--threads N...]
+                    [--tables N...] [--table-size N...]
+                    [--duration SECONDS...]
+                    [--report-interval SECONDS] [--reuse-dataset]
+                    [--prepare-threads N] [--distributed]
+                    [--target TARGET] [--start-delay SECONDS]
+
+Launch sysbench tests, once per combination of the given workloads,
+threads, tables, table sizes and durations.
+
+The sbtest tables are cleaned up and prepared before every run. They
+are kept instead with --reuse-dataset, as long as the number and size
+of tables stay the same and their row counts and checksums did not
+change since the end of the previous run.
+
+A single sysbench client runs on the first database node by default.
+In distributed mode, every host of the sysbench group runs a client and
+all of them start at the same time, a few seconds after the tables are
+ready.
 
-Launch sysbench tests.
+Options:
+  --workload WORKLOAD         sysbench OLTP workload, e.g.,
+                              oltp_read_only, oltp_write_only,
+                              oltp_point_select [default: oltp_read_write]
+  --threads N                 Number of client threads [default: 1]
+  --tables N                  Number of tables [default: 1]
+  --table-size N              Number of rows per table [default: 1000000]
+  --duration SECONDS          Duration of each run [default: 10]
+  --report-interval SECONDS   Period of the intermediate reports
+                              [default: 10]
+  --reuse-dataset             Keep the tables of the previous run when
+                              they are still valid
+  --prepare-threads N         Number of threads loading the tables, at
+                              most one per table is useful [default: 1]
+  --distributed               Run a client on every sysbench host
+  --target TARGET             Database node of each client in distributed
+                              mode, either local (the node on the same
+                              host) or round-robin [default: local]
+  --start-delay SECONDS       Time given to the distributed clients to be
+                              ready before they all start [default: 30]
     """
-    # Generate inventory
-    extra_vars = {
-        "registry": env["config"]["registry"],
-        "db": env.get('db', 'cockroachdb'),
-        "enos_action": "stress"
-    }
-    # use deploy of each role
-    run_ansible('stress.yml', extra_vars=extra_vars)
+    if target not in ['local', 'round-robin']:
+        raise Exception(
+            'The target {!r} is neither local nor round-robin'.format(target))
+
+    # Runs on the same tables follow each other, so that --reuse-dataset
+    # only prepares them once
+    matrix = itertools.product(tables, table_size, workload, threads,
+                               duration)
+    for tbls, size, wkld, thrds, secs in matrix:
+        logging.info("sysbench %s with %s threads on %s tables of %s rows "
+                     "for %ss" % (wkld, thrds, tbls, size, secs))
+        extra_vars = {
+            "registry": env["config"]["registry"],
+            "db": env.get('db', 'cockroachdb'),
+            "enos_action": "stress",
+            "sysbench_workload": wkld,
+            "sysbench_threads": int(thrds),
+            "sysbench_tables": int(tbls),
+            "sysbench_table_size": int(size),
+            "sysbench_time": int(secs),
+            "sysbench_report_interval": int(report_interval),
+            "sysbench_reuse_dataset": reuse_dataset,
+            "sysbench_prepare_threads": int(prepare_threads),
+            "sysbench_distributed": distributed,
+            "sysbench_target": target,
+            "sysbench_start_delay": int(start_delay)
+        }
+        run_ansible('stress.yml', extra_vars=extra_vars)
 
 
 @doc()
 @enostask()
-def rally(files, directory, high, env=None, **kwargs):
+def rally(files, directory, high, parallelism=1, env=None, **kwargs):
     """
 usage: juice rally [--files FILE... | --directory DIRECTORY] [--high]
+                   [--parallelism N]
 
 Benchmark the Openstack
 
@@ -235,6 +475,8 @@ from rally scenarios folder).
   --directory DIRECTORY  Directory that contains rally scenarios. [default:
 keystone]
   --high                 Use high mode or not
+  --parallelism N        Number of scenarios running at the same time on
+                         each rally node [default: 1]
     """
     logging.info("Launching rally using scenarios: %s" % (', '.join(files)))
     logging.info("Launching rally using all scenarios in %s directory.",
@@ -252,7 +494,11 @@ keystone]
     env['rally_nodes'] = rally_nodes
 
     extra_vars = {
-        "rally_nodes": rally_nodes
+        "rally_nodes": rally_nodes,
+        "rally_parallelism": int(parallelism),
+        # Labels the scenario containers of this run, see the timeline
+        # in the rally role
+        "rally_run": str(int(time.time()))
     }
     if files:
         extra_vars.update({"rally_files": files})
@@ -277,10 +523,15 @@ usage: juice emulate
 
 Emulate network using: {0}
     """
+    from enoslib.api import emulate_network
+
     inventory = env["inventory"]
     roles = env["roles"]
     logging.info("Emulates using constraints: %s" % tc)
-    emulate_network(roles, inventory, tc)
+    if env.get('dry_run'):
+        record_call(env, 'emulate_network', tc=tc)
+    else:
+        emulate_network(roles, inventory, tc)
     env["latency"] = tc['constraints'][0]['delay']
 
 
@@ -292,9 +543,14 @@ usage: juice validate
 
 Validate network. Doesn't work for now since there is no flent installed
     """
+    from enoslib.api import validate_network
+
     inventory = env["inventory"]
     roles = env["roles"]
-    validate_network(roles, inventory)
+    if env.get('dry_run'):
+        record_call(env, 'validate_network')
+    else:
+        validate_network(roles, inventory)
 
 
 @doc(SYMLINK_NAME)
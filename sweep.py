@@ -0,0 +1,205 @@
+"""Pipelined execution of the sweeps of experiments
+
+The sweeps of experiments.py used to run every combination from
+scratch: deploy, openstack, emulate, rally, backup and then destroy.
+`PipelinedSweep` runs the same steps but
+
+- picks the combinations in an order that minimizes the number of
+  deployments: combinations of the live deployment first, and the delay
+  last since `emulate` alone changes it,
+- reuses the live deployment when only the delay (or other parameters
+  that are not part of the deployment, e.g., burst) change, in which
+  case only the rally, sysbench and monitoring data are reset,
+- archives combination N on the nodes as soon as it is done, and pulls
+  the archives while combination N+1 is deployed, emulated and run,
+  each combination into its own result directory. Ansible is not
+  thread safe, only the pull, which does not run it, runs in another
+  process with a copy of the state.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import logging
+import os
+from pprint import pformat
+
+import juice as j
+from utils import enostask, run_ansible
+
+
+class PipelinedSweep(object):
+    """Runs the combinations of an execo `ParamSweeper`
+
+    :param sweeper: the ParamSweeper of the experiment
+    :param conf: juice configuration, the `tc` of each combination is
+      derived from it
+    :param run: function of the combination that runs the benchmark on
+      the deployment, e.g., `juice.rally`
+    :param xp_name: function of the combination that gives the name of
+      its result directory, e.g., cockroachdb-9-50
+    :param setup: function of (conf, combination) that updates the copy
+      of `conf` for a combination, e.g., its number of nodes
+    :param deployment: parameters of the combinations that require a new
+      deployment when they change
+    :param delay: parameter of the combinations holding the delay (ms)
+      emulated between database nodes, if any
+    :param results_dir: where the result directories are written, the
+      backup of a combination goes to <xp_name>/backup/<xp_name>, as
+      analysis expects it
+    """
+
+    def __init__(self, sweeper, conf, run, xp_name, setup=None,
+                 deployment=('db', 'db-nodes'), delay='delay',
+                 results_dir='.'):
+        self.sweeper = sweeper
+        self.conf = conf
+        self.run = run
+        self.xp_name = xp_name
+        self.setup = setup
+        self.deployment = list(deployment)
+        self.delay = delay
+        self.results_dir = os.path.abspath(results_dir)
+        # Deployment parameters of the live deployment, None if there is
+        # none or if it cannot be trusted after a failure
+        self._deployed = None
+        # Number of failures of the combinations, retried after the others
+        self._failures = {}
+
+    def start(self):
+        """Runs every remaining combination of the sweeper"""
+        executor = ProcessPoolExecutor(max_workers=1)
+        # (combination, future) of the running backup, if any
+        backup = None
+        try:
+            while True:
+                combination = self.sweeper.get_next(self._order)
+                if combination is None:
+                    break
+                logging.info("Treating combination %s"
+                             % pformat(combination))
+                backup = self._combination(combination, backup, executor)
+            self._finish(backup)
+            # Like the combinations of the former sweeps, the last one
+            # does not leave its deployment running
+            self._teardown()
+        finally:
+            executor.shutdown()
+
+    def _combination(self, combination, backup, executor):
+        """Runs `combination` while `backup` is pulled
+
+        Returns the backup of `combination`, or None if it failed.
+        """
+        conf = copy.deepcopy(self.conf)
+        if self.setup is not None:
+            self.setup(conf, combination)
+        if self.delay is not None:
+            latency = "%sms" % combination[self.delay]
+            conf['tc']['constraints'][0]['delay'] = latency
+        name = self.xp_name(combination)
+        reuse = self._key(combination) == self._deployed
+        backup_dir = os.path.join(self.results_dir, name, 'backup', name)
+        try:
+            # The archives of the previous combination are already on the
+            # nodes, in a directory that neither destroy nor deploy touch
+            if not reuse:
+                self._teardown()
+                j.deploy(conf=conf, xp_name=name)
+                j.openstack()
+                self._deployed = self._key(combination)
+            if self.delay is not None:
+                j.emulate(conf['tc'])
+            if reuse:
+                _reset_results()
+            self.run(combination)
+            # Archiving overwrites the archives of the previous combination
+            backup = self._finish(backup)
+            os.makedirs(backup_dir, exist_ok=True)
+            env = _load_env()
+            j.archive_backup(env, backup_dir=backup_dir, parallel=True)
+        except Exception as e:
+            # Oh no, something goes wrong! Mark combination as cancel for
+            # a later retry
+            logging.error("Combination %s Failed with message %s"
+                          % (pformat(combination), e))
+            self._finish(backup)
+            self._cancel(combination)
+            self._deployed = None
+            return None
+        return combination, executor.submit(j.pull_backup, env,
+                                            backup_dir=backup_dir)
+
+    def _finish(self, backup):
+        """Waits for `backup` and marks its combination as done
+
+        Returns None, i.e., no more backup is running.
+        """
+        if backup is None:
+            return None
+        combination, future = backup
+        try:
+            future.result()
+        except Exception as e:
+            logging.error("Backup of %s Failed with message %s"
+                          % (pformat(combination), e))
+            self._cancel(combination)
+        else:
+            self.sweeper.done(combination)
+            logging.info("End of combination %s" % pformat(combination))
+        return None
+
+    def _cancel(self, combination):
+        self._failures[combination] = self._failures.get(combination, 0) + 1
+        self.sweeper.cancel(combination)
+
+    def _teardown(self):
+        try:
+            j.destroy()
+        except Exception as e:
+            logging.warning(
+                "Teardown went wrong. This is not necessarily a bad news, "
+                "in particular, if it is the first time you run the "
+                "experiment: %s" % e)
+        self._deployed = None
+
+    def _key(self, combination):
+        return tuple(combination[p] for p in self.deployment)
+
+    def _order(self, remaining):
+        """Combinations of the live deployment first, delay last"""
+        def key(combination):
+            others = sorted(p for p in combination
+                            if p not in self.deployment and p != self.delay)
+            return (self._failures.get(combination, 0),
+                    self._key(combination) != self._deployed,
+                    self._key(combination),
+                    tuple(combination[p] for p in others),
+                    combination.get(self.delay))
+        return sorted(remaining, key=key)
+
+
+@enostask()
+def _load_env(env=None, **kwargs):
+    """Copy of the state, for the backup running in another process"""
+    return copy.deepcopy(env)
+
+
+@enostask()
+def _reset_results(env=None, **kwargs):
+    """Removes the data of the previous combination from the deployment
+
+    The rally results are removed, InfluxDB and the sysbench results
+    directory are destroyed and deployed again. The databases are kept,
+    but the sysbench tables are prepared again at the next stress since
+    their fingerprint is gone.
+    """
+    extra_vars = {
+        "db": env['db'],
+        "monitoring": env['monitoring'],
+        "rally_nodes": env.get('rally_nodes', []),
+    }
+    run_ansible('rally.yml', extra_vars=dict(extra_vars,
+                                             enos_action="destroy"))
+    for action in ['destroy', 'deploy']:
+        run_ansible('scaffolding.yml', tags=['influxdb', 'sysbench'],
+                    extra_vars=dict(extra_vars, enos_action=action))
@@ -1,12 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from functools import wraps
+import ipaddress
+import json
 import logging
 import os
+import subprocess
 import time
 
 from docopt import docopt
-from enoslib.api import run_ansible as enos_run_ansible
-from enoslib.task import enostask
 
 
 JUICE_PATH = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
@@ -51,6 +53,36 @@ Usage:
                                               error_lookup.__doc__))
 
 
+def enostask(new=False):
+    """Defers the import of `enoslib.task.enostask` to the first call
+
+    Importing enoslib pulls ansible and the providers in, which makes
+    every command slow to start, even `help`.
+
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def decorated(*args, **kwargs):
+            from enoslib.task import enostask as enos_enostask
+            return enos_enostask(new=new)(fn)(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def record_call(env, call, **kwargs):
+    """Records `call` instead of running it, for dry runs
+
+    Calls are appended to the `calls.jsonl` file of the result directory
+    rather than to the env, which nested tasks overwrite.
+
+    """
+    record = {'time': time.time(), 'call': call}
+    record.update(kwargs)
+    with open(os.path.join(env['resultdir'], 'calls.jsonl'), 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+    logging.info("Dry run of %s" % call)
+
+
 @enostask()
 def run_ansible(playbook, extra_vars=None, tags=None,
                 on_error_continue=False, env=None, **kwargs):
@@ -60,6 +92,23 @@ def run_ansible(playbook, extra_vars=None, tags=None,
     returns value of `enoslib.api.run_ansible`.
 
     """
+    return run_playbook(env, playbook, extra_vars, tags, on_error_continue)
+
+
+def run_playbook(env, playbook, extra_vars=None, tags=None,
+                 on_error_continue=False):
+    """`run_ansible` with the given state, which it neither loads nor saves
+
+    Playbooks running at the same time in different processes use it,
+    since they would all save the state otherwise.
+
+    """
+    if env.get('dry_run'):
+        record_call(env, playbook, extra_vars=extra_vars, tags=tags)
+        return
+
+    from enoslib.api import run_ansible as enos_run_ansible
+
     inventory = env["inventory"]
     playbooks = [os.path.join(ANSIBLE_PATH, playbook)]
 
@@ -68,14 +117,156 @@ def run_ansible(playbook, extra_vars=None, tags=None,
 
 ######################################################################
 # Provider deployments
-from enoslib.infra.enos_g5k.provider import G5k
 
 @enostask(new=True)
-def g5k_deploy(g5k_config, env=None, force_deploy=False, **kwargs):
+def g5k_deploy(g5k_config, env=None, force_deploy=False, timeout=300,
+               **kwargs):
+    from enoslib.infra.enos_g5k.provider import G5k
+
     provider = G5k(g5k_config)
     roles, networks = provider.init(force_deploy=force_deploy)
     env['roles'] = roles
     env['networks'] = networks
-    logging.info('Wait 30 seconds for iface to be ready...')
-    time.sleep(30)
+    logging.info('Wait for hosts and iface to be ready...')
+    env['readiness'] = wait_ready(roles, networks, timeout=timeout)
+    return env
+
+
+def wait_ready(roles, networks, network_role='database_network',
+               timeout=300, period=2):
+    """Waits until every host of `roles` is ready
+
+    A host is ready once it answers on ssh and one of its interfaces has
+    an address in a network of `network_role`. Hosts are probed
+    concurrently, every `period` seconds.
+
+    Returns the seconds each host took to be ready, by alias, or raises
+    an exception with the hosts still not ready after `timeout` seconds.
+
+    """
+    cidrs = [ipaddress.ip_network(network['cidr'], strict=False)
+             for network in networks
+             if network_role in network.get('roles', [])]
+    hosts = {host.alias: host for hs in roles.values() for host in hs}
+    start = time.time()
+
+    def probe(host):
+        while time.time() - start < timeout:
+            if _is_ready(host, cidrs, period):
+                return time.time() - start
+            time.sleep(period)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(len(hosts), 1)) as executor:
+        futures = {alias: executor.submit(probe, host)
+                   for alias, host in hosts.items()}
+        readiness = {alias: future.result()
+                     for alias, future in futures.items()}
+
+    late = sorted(alias for alias, t in readiness.items() if t is None)
+    if late:
+        raise Exception('Hosts {!r} are not ready after {}s'.format(
+            late, timeout))
+    for alias in sorted(readiness, key=readiness.get):
+        logging.info('%s ready in %.1fs' % (alias, readiness[alias]))
+    return readiness
+
+
+def ssh_options(host, connect_timeout=10):
+    """Options of ssh and scp to connect to `host`"""
+    options = ['-o', 'BatchMode=yes',
+               '-o', 'StrictHostKeyChecking=no',
+               '-o', 'ConnectTimeout=%d' % max(connect_timeout, 1),
+               '-o', 'User=%s' % (host.user or 'root')]
+    if host.port:
+        options += ['-o', 'Port=%s' % host.port]
+    if host.keyfile:
+        options += ['-o', 'IdentityFile=%s' % host.keyfile]
+    return options
+
+
+def _is_ready(host, cidrs, connect_timeout):
+    """Whether `host` answers on ssh with an address in one of `cidrs`"""
+    command = (['ssh'] + ssh_options(host, connect_timeout) +
+               [host.address, 'ip', '-o', '-4', 'addr', 'show', 'up'])
+    try:
+        out = subprocess.check_output(command, stderr=subprocess.DEVNULL,
+                                      universal_newlines=True)
+    except subprocess.CalledProcessError:
+        return False
+    # e.g., 3: eth1    inet 10.24.0.2/18 brd 10.24.63.255 scope global eth1
+    addresses = [ipaddress.ip_interface(line.split()[3]).ip
+                 for line in out.splitlines() if len(line.split()) > 3]
+    return not cidrs or any(address in cidr
+                            for address in addresses for cidr in cidrs)
+
+
+@enostask(new=True)
+def local_deploy(local_config, env=None, **kwargs):
+    """Fabricates roles and networks of fake hosts
+
+    Hosts and networks are described like the resources of g5k, without
+    the clusters and sites, e.g.:
+
+        machines:
+          - roles: [database, sysbench]
+            nodes: 3
+        networks:
+          - roles: [database_network]
+
+    Every fake host is an alias of localhost. Ansible never runs against
+    them: the env is marked as a dry run, see `run_ansible`.
+
+    """
+    from enoslib.host import Host
+
+    networks = []
+    for i, network in enumerate(local_config.get('networks', [])):
+        cidr = network.get('cidr', '10.%d.0.0/16' % i)
+        networks.append({
+            'roles': network['roles'],
+            'cidr': cidr,
+            'gateway': cidr.split('/')[0],
+            'dns': '127.0.0.1'
+        })
+    # Playbooks look up the interface of a network role in the hostvars
+    interfaces = {role: 'lo' for network in networks
+                             for role in network['roles']}
+
+    roles = {}
+    count = 0
+    for machine in local_config.get('machines', []):
+        for _ in range(machine.get('nodes', 1)):
+            count += 1
+            host = Host('127.0.0.%d' % count, alias='local-%d' % count,
+                        user='root', extra=dict(interfaces,
+                                                ansible_connection='local'))
+            for role in machine['roles']:
+                roles.setdefault(role, []).append(host)
+
+    env['roles'] = roles
+    env['networks'] = networks
+    env['dry_run'] = True
     return env
+
+
+def pull(hosts, pattern, dest, workers=8):
+    """Copies the files matching `pattern` on `hosts` into `dest`
+
+    Hosts are pulled concurrently with scp, by at most `workers` at a
+    time. Hosts without any matching file are skipped with a warning.
+
+    """
+    def scp(host):
+        command = (['scp', '-q'] + ssh_options(host) +
+                   ['%s:%s' % (host.address, pattern), dest])
+        start = time.time()
+        if subprocess.call(command, stderr=subprocess.DEVNULL) != 0:
+            logging.warning('Nothing pulled from %s:%s' % (host.alias,
+                                                          pattern))
+        else:
+            logging.info('%s pulled in %.1fs' % (host.alias,
+                                                 time.time() - start))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        list(executor.map(scp, hosts))